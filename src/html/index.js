@@ -0,0 +1,125 @@
+// Index pages: loads the SQL of a topic when its card is expanded, and searches all topics
+// with the search index built with the website (topics/search-index.json, see catalogue.py),
+// which is only downloaded when the search box is used.
+(function() {
+    var MAX_RESULTS = 50;
+    var searchIndex = null; // promise of the search index
+    var terms = null; // sorted words of the index
+
+    // SQL of the topics, loaded once
+    document.addEventListener("toggle", function(event) {
+        var details = event.target;
+        if (!details.open || !details.dataset || !details.dataset.sql || details.dataset.loaded) {
+            return;
+        }
+        details.dataset.loaded = "true";
+        var pre = details.querySelector("pre");
+        pre.textContent = "Loading...";
+        fetch(details.dataset.sql)
+            .then(function(response) { return response.ok ? response.text() : "No SQL found"; })
+            .then(function(sql) { pre.textContent = sql; })
+            .catch(function() {
+                pre.textContent = "No SQL found";
+                delete details.dataset.loaded;
+            });
+    }, true);
+
+    function loadIndex() {
+        if (!searchIndex) {
+            searchIndex = fetch("topics/search-index.json")
+                .then(function(response) { return response.json(); })
+                .then(function(index) {
+                    terms = Object.keys(index.terms).sort();
+                    return index;
+                });
+        }
+        return searchIndex;
+    }
+
+    // positions of the topics containing a word starting with `prefix`
+    function lookup(index, prefix) {
+        var found = new Set();
+        var lo = 0, hi = terms.length;
+        while (lo < hi) { // first word >= prefix
+            var mid = (lo + hi) >> 1;
+            if (terms[mid] < prefix) { lo = mid + 1; } else { hi = mid; }
+        }
+        for (var i = lo; i < terms.length && terms[i].lastIndexOf(prefix, 0) === 0; i++) {
+            index.terms[terms[i]].forEach(function(t) { found.add(t); });
+        }
+        return found;
+    }
+
+    function search(index, query) {
+        var words = query.toLowerCase().match(/[a-z0-9]+/g) || [];
+        var matches = null;
+        words.forEach(function(word) {
+            var found = lookup(index, word);
+            matches = matches === null ? found : new Set(Array.from(matches).filter(function(t) { return found.has(t); }));
+        });
+        return Array.from(matches || []).sort(function(a, b) { return a - b; });
+    }
+
+    function card(topic) {
+        var id = topic[0], title = topic[1], sql = topic[2], networks = topic[3];
+        var col = document.createElement("div");
+        col.className = "col-md-6";
+        col.innerHTML = '<div class="card"><h6 class="card-header">Topic: <a target="_blank"></a></h6>' +
+            '<div class="card-body"><small class="networks">Networks: </small>' +
+            '<details class="topic-query"><summary><small>Query</small></summary><pre></pre></details></div></div>';
+        var link = col.querySelector("h6 a");
+        link.textContent = title;
+        link.href = "wrapper.html?topicId=" + encodeURIComponent(id) + "&network=" + (networks[0] || "concepts");
+        networks.forEach(function(network, i) {
+            var a = document.createElement("a");
+            a.href = "wrapper.html?topicId=" + encodeURIComponent(id) + "&network=" + network;
+            a.target = "_blank";
+            a.textContent = network.charAt(0).toUpperCase() + network.slice(1);
+            var networksElement = col.querySelector(".networks");
+            if (i > 0) {
+                networksElement.appendChild(document.createTextNode(" | "));
+            }
+            networksElement.appendChild(a);
+        });
+        col.querySelector("details").dataset.sql = sql;
+        return col;
+    }
+
+    var input = document.getElementById("topic-search");
+    var status = document.getElementById("topic-search-status");
+    var results = document.getElementById("topic-results");
+    var pages = document.getElementById("topic-pages");
+    var timer = null;
+
+    function update() {
+        var query = input.value.trim();
+        if (!query) {
+            results.hidden = true;
+            pages.hidden = false;
+            status.textContent = "";
+            return;
+        }
+        loadIndex().then(function(index) {
+            if (input.value.trim() !== query) {
+                return; // typed meanwhile
+            }
+            var found = search(index, query);
+            status.textContent = found.length === 0 ? "No topics found" :
+                found.length + (found.length === 1 ? " topic" : " topics") +
+                (found.length > MAX_RESULTS ? ", showing the first " + MAX_RESULTS : "");
+            results.replaceChildren.apply(results, found.slice(0, MAX_RESULTS).map(function(t) { return card(index.topics[t]); }));
+            results.hidden = false;
+            pages.hidden = true;
+        }).catch(function() {
+            status.textContent = "Search is not available";
+        });
+    }
+
+    if (input) {
+        input.addEventListener("focus", loadIndex);
+        input.addEventListener("input", function() {
+            clearTimeout(timer);
+            timer = setTimeout(update, 150);
+        });
+    }
+})();
@@ -0,0 +1,28 @@
+// Reloads the page when the website is rebuilt, e.g. by `dimensions-networks --runserver --watch`.
+// Only when browsing the local server: the website can be published on any static web server,
+// which doesn't know about /api/build.
+(function() {
+    if (["localhost", "127.0.0.1", "[::1]"].indexOf(window.location.hostname) < 0) {
+        return;
+    }
+    var built = null;
+
+    function check() {
+        fetch("api/build", {cache: "no-store"})
+            .then(function(response) { return response.ok ? response.json() : null; })
+            .then(function(status) {
+                if (!status) {
+                    return; // not served by dimensions-networks
+                }
+                if (built !== null && status.built !== built) {
+                    window.location.reload();
+                    return;
+                }
+                built = status.built;
+                setTimeout(check, 1000);
+            })
+            .catch(function() { setTimeout(check, 5000); }); // server restarting
+    }
+
+    check();
+})();
@@ -2,13 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import os
+import threading
 import click
 
 from .settings import *
 from .networkgen.helpers import *
 from .networkgen.networkgen import * 
 from .networkgen.vosviewer import *
+from .networkgen.scheduler import *
+from .networkgen.manifest import BuildManifest
+from .networkgen.local import snapshot_files
+from .networkgen.writers import WRITERS
+from .networkgen.api import NetworkService
 from .networkgen import server as run_server 
+from .networkgen.watch import watch_topics
+from .networkgen import bqdata
 
 
 
@@ -32,6 +40,80 @@ from .networkgen import server as run_server
 @click.option(
     "--port", "-p", default=8009,
     help="Specify the port on which the webserver should listen for connections (default: 8009).")
+@click.option(
+    "--api",
+    is_flag=True,
+    help="With --runserver, also generate networks on demand at /api/network?topic=...&type=... (see README).")
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Bypass the local query results cache: always query BigQuery and do not store results. All networks are regenerated.")
+@click.option(
+    "--refresh-cache",
+    is_flag=True,
+    help="Ignore cached query results, query BigQuery and store the new results in the cache. All networks are regenerated.")
+@click.option(
+    "--jobs", "-j", "jobs_number", default=1,
+    help="How many BigQuery jobs to run concurrently (default: 1).")
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    help="Estimate how many bytes each query would process in BigQuery, without running them.")
+@click.option(
+    "--max-bytes",
+    help="Maximum bytes a single query may process, eg 20GB. Queries estimated above it are not run, and BigQuery jobs are capped to it.")
+@click.option(
+    "--over-budget",
+    type=click.Choice(['skip', 'abort']), default='skip',
+    help="What to do when a query is estimated above --max-bytes: skip that network only, or abort the whole run (default: skip).")
+@click.option(
+    "--materialize-subset", "-m",
+    is_flag=True,
+    help="Run each topic query only once, into a temporary table shared by all network types for that topic.")
+@click.option(
+    "--backend", "-b",
+    type=click.Choice(BACKENDS), default='bigquery',
+    help="Compute networks in BigQuery, or locally from a snapshot of the publications table (default: bigquery).")
+@click.option(
+    "--snapshot",
+    default=DEFAULT_SNAPSHOT_PATH,
+    help="Folder containing the publications snapshot used by the local backend (default: the `snapshot` folder of the project, next to `topics`).")
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Regenerate all networks, including those whose inputs have not changed since the last build.")
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="Compute the networks of all topics with a single BigQuery job per network type, instead of one job per topic.")
+@click.option(
+    "--compact-links",
+    is_flag=True,
+    help="Don't store link URLs: the viewer builds them from a template and the search fragments of the nodes (much smaller files).")
+@click.option(
+    "--integer-ids",
+    is_flag=True,
+    help="Identify nodes with integer IDs instead of their labels, so that each label is stored only once (smaller files).")
+@click.option(
+    "--layout/--no-layout",
+    default=True,
+    help="Compute the layout of the networks when building them, instead of in the browser (default: on). Networks with more than STREAM_MIN_LINKS links are streamed without layout.")
+@click.option(
+    "--clusters/--no-clusters",
+    default=True,
+    help="Compute the clusters of the networks when building them, instead of in the browser (default: on). Networks with more than STREAM_MIN_LINKS links are streamed without clusters.")
+@click.option(
+    "--format", "formats",
+    type=click.Choice(sorted(WRITERS)), multiple=True, default=["vosviewer"],
+    help="Output format of the networks (default: vosviewer). Can be repeated to write several formats at once.")
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running, and rebuild the networks of the topic files whenever they change. With --runserver, also serve the website meanwhile.")
+@click.option(
+    "--hardlink",
+    is_flag=True,
+    help="Publish the website by hardlinking new files from the topics folder instead of copying them (same file system only).")
 @click.option('--verbose', is_flag=True, help='Verbose mode')
 @click.pass_context
 def main_cli(ctx, filename=None,  
@@ -40,7 +122,26 @@ def main_cli(ctx, filename=None,
                 fulldimensions=False, 
                 keyword=None, 
                 runserver=False, 
-                port=None,):
+                port=None,
+                api=False,
+                no_cache=False,
+                refresh_cache=False,
+                jobs_number=1,
+                dry_run=False,
+                max_bytes=None,
+                over_budget='skip',
+                materialize_subset=False,
+                backend='bigquery',
+                snapshot=DEFAULT_SNAPSHOT_PATH,
+                force=False,
+                batch=False,
+                compact_links=False,
+                integer_ids=False,
+                layout=True,
+                clusters=True,
+                formats=("vosviewer",),
+                watch=False,
+                hardlink=False,):
     """dimensions-networks: Python tool to boostrap science maps powered by data from Dimensions on Google BigQuery. Example: 
 
 dimensions-networks {QUERY_FILE}
@@ -48,20 +149,42 @@ dimensions-networks {QUERY_FILE}
 QUERY_FILE. File name containing the GBQ query to be converted into a network visualization. If a folder is passed, all files in the folder will be processed.     
 """
 
-    if not filename and not runserver and not buildindex and not keyword:
+    if not filename and not runserver and not buildindex and not keyword and not watch:
         # print dir(search_cli)
         printInfo(ctx.get_help())
         return
 
     if buildindex:
         set_up_env() # rebuild static files
-        build_website()
+        build_website(hardlink)
         return
 
 
+    if no_cache:
+        cache_mode = "off"
+    elif refresh_cache:
+        cache_mode = "refresh"
+    else:
+        cache_mode = "use"
+
+    if max_bytes is not None:
+        max_bytes = parse_size(max_bytes)
+
     if runserver:
-        run_server.go(port)
-        return
+        service = None
+        if api:
+            user_login(pool_size=BQ_HTTP_POOL_SIZE) # GBQ connection setup
+            service = NetworkService(
+                fulldimensions, cache_mode, max_bytes, backend, snapshot,
+                clustering=clusters, verbose=verbose,
+                compact_links=compact_links, integer_ids=integer_ids,
+            )
+        if not watch:
+            run_server.go(port, service=service)
+            return
+
+    if watch and not filename and not keyword:
+        filename = [DEFAULT_TOPICS_SQL_PATH]
 
     if keyword:
         query_file = gen_sql_from_keyword(keyword)
@@ -80,50 +203,160 @@ QUERY_FILE. File name containing the GBQ query to be converted into a network vi
         else:
             if os.path.isfile(filename[0]) and filename[0].endswith(".sql"):
                 files.append(filename[0])
-        if not files:
+        if not files and not watch:
             printDebug("No files found.", "red")
             return
 
 
         set_up_env()
-        user_login() # GBQ connection setup
+        user_login(pool_size=max(jobs_number, BQ_HTTP_POOL_SIZE)) # GBQ connection setup
 
 
-        # Build the networks for each file (default: overwrite pre-existing)
-        for sql_file in files:
-            printInfo("Reading file: {}".format(sql_file))
-            metadata = extract_query_metadata(sql_file, verbose=True)
+        def build(files):
+            """Builds the networks of some topic files, and the website. Returns the list of JobResult."""
+            # Build the networks for each file (default: overwrite pre-existing)
+            jobs = []
+            for sql_file in files:
+                printInfo("Reading file: {}".format(sql_file))
+                metadata = extract_query_metadata(sql_file, verbose=True)
             
-            if fulldimensions:
-                printInfo("..using full Dimensions data", "red")
+                if fulldimensions:
+                    printInfo("..using full Dimensions data", "red")
             
-            for task in metadata["network_types"]:
-
-                if task == 'organizations':
-                    db_data = gen_orgs_collab_network(sql_file, metadata, fulldimensions, verbose)
-                    render_json(
-                        db_data,
-                        task,
-                        'Organization', 
-                        'Organization',
-                        sql_file
-                    )
-
-                elif task == 'concepts':
-                    db_data = gen_concept_network(sql_file, metadata, fulldimensions, verbose)
-                    render_json(
-                        db_data,
-                        task,
-                        'Concept', 
-                        'Concept',
-                        sql_file, 
-                    )
+                for task in metadata["network_types"]:
+                    if task in NETWORK_TYPES:
+                        jobs.append(NetworkJob(sql_file, task, metadata))
+                    else:
+                        printDebug("Failed to start network generation of type: {}".format(task), "red")
+                        printDebug("   ... your query configuration does not match the valid network types: {}".format(NETWORK_TYPES), "comment")
+
+            # skip the networks whose inputs have not changed since the last build
+            manifest = BuildManifest()
+            dataset = gbq_dataset_name(fulldimensions)
+            build_options = {"backend": backend, "compact_links": compact_links, "integer_ids": integer_ids, "layout": layout, "clusters": clusters, "formats": sorted(set(formats))}
+            if backend == 'local':
+                build_options["snapshot"] = os.path.abspath(snapshot)
+                build_options["snapshot_files"] = snapshot_files(snapshot)
+
+            def inputs_hash(job):
+                return BuildManifest.inputs_hash(job.sql_file, job.task, job.metadata, dataset, **build_options)
+
+            # with --no-cache or --refresh-cache, the queries must run again: nothing is skipped
+            if not force and cache_mode == "use":
+                todo = [job for job in jobs if not manifest.is_current(job.sql_file, job.task, inputs_hash(job))]
+                if len(todo) < len(jobs):
+                    printInfo(f"Skipping {len(jobs) - len(todo)} networks whose inputs have not changed (use --force to regenerate them).", "comment")
+                jobs = todo
+
+            if batch:
+                if backend == 'bigquery':
+                    # from now on, `jobs` contains batches of topics
+                    jobs = make_batches(jobs, BATCH_MAX_TOPICS)
+                else:
+                    printDebug("Batch mode is only available with the bigquery backend: ignoring it.", "comment")
+
+            if dry_run or max_bytes is not None:
+                # estimate all queries before any billable job starts
+                estimates = {}
+
+                def estimate(job):
+                    if isinstance(job, NetworkBatch):
+                        topics = [(x.sql_file, x.metadata) for x in job.jobs]
+                        return estimate_network_batch(job.task, topics, fulldimensions, verbose, cache_mode)
+                    return estimate_network(job.task, job.sql_file, job.metadata, fulldimensions, verbose, cache_mode, backend)
+
+                def record(job, n_bytes):
+                    estimates[id(job)] = n_bytes
+
+                printInfo(f"Estimating {len(jobs)} queries with BigQuery dry runs...")
+                run_jobs(jobs, estimate, record, max_workers=jobs_number)
+
+                printInfo("Estimated bytes processed:", "important")
+                for job in jobs:
+                    if id(job) in estimates:
+                        printInfo(f"  {format_bytes(estimates[id(job)]):>10}  {job_name(job)}")
+                    else:
+                        printInfo(f"  {'n/a':>10}  {job_name(job)} (dry run failed)", "red")
+                printInfo(f"  {format_bytes(sum(estimates.values())):>10}  TOTAL", "important")
+
+                if dry_run:
+                    return None
+
+                over = [job for job in jobs if estimates.get(id(job), max_bytes + 1) > max_bytes]
+                if over:
+                    printDebug(f"{len(over)} queries exceed the budget of {format_bytes(max_bytes)}:", "red")
+                    for job in over:
+                        printDebug(f"  {job_name(job)}", "red")
+                    if over_budget == 'abort':
+                        printDebug("Aborting: no queries were run.", "red")
+                        if watch:
+                            return None # keep watching: the topic files may be edited to fit the budget
+                        ctx.exit(1)
+                    printDebug("Skipping them.", "red")
+                    jobs = [job for job in jobs if job not in over]
+
+            def run(job):
+                if isinstance(job, NetworkBatch):
+                    topics = [(x.sql_file, x.metadata) for x in job.jobs]
+                    return gen_network_batch(job.task, topics, fulldimensions, verbose, cache_mode, max_bytes)
+                return gen_network(job.task, job.sql_file, job.metadata, fulldimensions, verbose, cache_mode, max_bytes, materialize_subset, backend, snapshot)
+
+            def render(job, db_data):
+                if isinstance(job, NetworkBatch):
+                    # split the batch results back into one network per topic
+                    rendered = set()
+                    for topic_id, rows in db_data:
+                        render(job.jobs[topic_id], rows)
+                        rendered.add(topic_id)
+                    for topic_id, topic_job in enumerate(job.jobs):
+                        if topic_id not in rendered:
+                            render(topic_job, [])
+                    return
+
+                nodes, edges, files = render_network(
+                    db_data,
+                    job.task,
+                    job.sql_file,
+                    job.metadata,
+                    compact_links=compact_links,
+                    integer_ids=integer_ids,
+                    layout=layout,
+                    clustering=clusters,
+                    formats=sorted(set(formats)),
+                )
+                manifest.record(job.sql_file, job.task, inputs_hash(job), nodes, edges, files)
+                manifest.save()
+
+            printInfo(f"Running {len(jobs)} network jobs ({jobs_number} at a time)...")
+            results = run_jobs(jobs, run, render, max_workers=jobs_number)
+            print_jobs_summary(results)
+            print_query_timings(bqdata.get_client().timings)
+
+            # rebuild the website
+            build_website(hardlink)
+            return results
+
+        if watch and runserver:
+            # serve the website while the networks are built
+            if not os.path.exists(DEFAULT_BUILD_PATH):
+                build_website(hardlink)
+            threading.Thread(target=run_server.go, args=(port,), kwargs={"service": service}, daemon=True).start()
+
+        results = build(files)
+
+        if watch:
+            def rebuild(changed, deleted):
+                if deleted:
+                    set_up_env() # remove the networks of deleted topics
+                if changed:
+                    build(changed)
                 else:
-                    printDebug("Failed to start network generation of type: {}".format(task), "red")
-                    printDebug("   ... your query configuration does not match the valid network types: {}".format(NETWORK_TYPES), "comment")
+                    build_website(hardlink)
+
+            watch_topics(rebuild, filename[0]) # the folder or file given on the command line
 
-        # rebuild the website
-        build_website()
+        elif results and any(r.error is not None for r in results):
+            ctx.exit(1)
 
 
 
@@ -0,0 +1,220 @@
+"""
+Networks generated on demand by the web server (`--runserver --api`), e.g.
+
+    /api/network?topic=herd-immunity&type=concepts&max_nodes=200&min_edge_weight=5
+
+builds the concepts network of `topics/herd-immunity.sql`, with the parameters of the
+request (see API_PARAMETERS) overriding those of the topic file, and returns it in
+VOSviewer JSON format.
+
+  - Results are cached in memory and on disk (see NetworkCache), keyed on all the inputs
+    of the network: repeated requests don't run any query, nor render the network again.
+  - Identical concurrent requests are coalesced: the first one generates the network, and
+    the others wait for its result.
+  - At most API_MAX_JOBS networks are generated at the same time, so that a burst of
+    requests can't launch dozens of BigQuery jobs. Further requests wait for their turn,
+    for up to API_QUEUE_TIMEOUT seconds.
+"""
+
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from ..settings import *
+from .helpers import *
+from .bqdata import QueryCache, SendQueryError
+from .manifest import BuildManifest
+from .networkgen import gen_network
+from .vosviewer import build_network, needs_network, render_json, stream_json
+
+
+
+EMPTY_NETWORK = b'{"network": {"items": [], "links": []}}'
+
+
+
+class ApiError(Exception):
+    """An error answered to the client, with an HTTP status code."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+
+class NetworkCache(QueryCache):
+    """
+    Cache of the networks generated on demand, as VOSviewer JSON files. The most recently
+    used ones are also kept in memory, up to `memory_size` bytes.
+    """
+
+    extension = ".json"
+
+    def __init__(self, path=DEFAULT_API_CACHE_PATH, ttl=API_CACHE_TTL, max_size=API_CACHE_MAX_SIZE, memory_size=API_MEMORY_CACHE_SIZE):
+        super().__init__(path, ttl, max_size)
+        self.memory_size = memory_size
+        self.memory = OrderedDict()  # key => (JSON bytes, creation time)
+        self.lock = threading.Lock()
+
+    def file(self, key):
+        """Returns the path of the file where the network of a key is to be written."""
+        os.makedirs(self.path, exist_ok=True)
+        return self._file(key)
+
+    def get(self, key):
+        """Returns the JSON of the network cached for a key, or None if missing or stale."""
+        with self.lock:
+            if key in self.memory:
+                body, created = self.memory[key]
+                if self.ttl is None or time.time() - created <= self.ttl:
+                    self.memory.move_to_end(key)
+                    return body
+                del self.memory[key]
+        filename = self._touch(key)
+        if filename is None:
+            return None
+        return self._remember(key, filename)
+
+    def add(self, key):
+        """Adds the network written to `file(key)` to the cache, and returns its JSON."""
+        body = self._remember(key, self._file(key))
+        self.evict()
+        return body
+
+    def _remember(self, key, filename):
+        """Keeps the JSON of a cached file in memory, and returns it (None if it was just evicted, see _touch)."""
+        try:
+            with open(filename, "rb") as input:
+                body = input.read()
+                created = os.fstat(input.fileno()).st_mtime
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.memory[key] = (body, created)
+            self.memory.move_to_end(key)
+            size = sum(len(x[0]) for x in self.memory.values())
+            while size > self.memory_size and len(self.memory) > 1:
+                size -= len(self.memory.popitem(last=False)[1][0])
+        return body
+
+
+
+class NetworkService:
+    """
+    Generates networks on demand, see `network`.
+
+    The options are those of the command line: they apply to all the networks generated.
+    `render_options` are passed to render_json (e.g. `compact_links`). Networks are not laid
+    out (see layout.py), which can take minutes and hold a job slot meanwhile: the viewer does it.
+    """
+
+    def __init__(self, fulldimensions=False, cache_mode="use", max_bytes=None, backend="bigquery", snapshot_path=DEFAULT_SNAPSHOT_PATH,
+                 clustering=True, max_jobs=API_MAX_JOBS, queue_timeout=API_QUEUE_TIMEOUT, cache=None, verbose=False, **render_options):
+        self.fulldimensions = fulldimensions
+        self.cache_mode = cache_mode
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.snapshot_path = snapshot_path
+        self.clustering = clustering
+        self.render_options = render_options
+        self.verbose = verbose
+        self.cache = cache or NetworkCache()
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.queue_timeout = queue_timeout
+        self.pending = {}  # key => Future of the network being generated
+        self.lock = threading.Lock()
+        self.options = {"backend": backend, "layout": False, "clusters": clustering, **render_options}
+        if backend == 'local':
+            self.options["snapshot"] = os.path.abspath(snapshot_path)
+
+
+    def parse(self, params):
+        """
+        Returns the (sql_file, task, config) of a network request, given its query parameters.
+        Raises ApiError for unknown topics or invalid parameters.
+        """
+        topic, task = params.get("topic", ""), params.get("type", "")
+        sql_file = f"{DEFAULT_TOPICS_SQL_PATH}/{topic}.sql"
+        if not re.fullmatch(r"[\w\-]+", topic) or not os.path.isfile(sql_file):
+            raise ApiError(404, f"Unknown topic: {topic!r}")
+        if task not in NETWORK_TYPES:
+            raise ApiError(400, f"Invalid network type: {task!r} (expected one of {', '.join(NETWORK_TYPES)})")
+
+        config = extract_query_metadata(sql_file)
+        for name in API_PARAMETERS:
+            if name in params:
+                try:
+                    value = float(params[name]) if isinstance(NETWORK_PARAMETERS_DEFAULT[name], float) else int(params[name])
+                except ValueError:
+                    raise ApiError(400, f"Invalid value for {name}: {params[name]!r}") from None
+                if not math.isfinite(value) or value < 0 or (name == "max_nodes" and not 0 < value <= API_MAX_NODES):
+                    raise ApiError(400, f"Out of range value for {name}: {params[name]!r}")
+                config[name] = str(value)
+        unknown = set(params) - set(API_PARAMETERS) - {"topic", "type"}
+        if unknown:
+            raise ApiError(400, f"Unknown parameters: {', '.join(sorted(unknown))}")
+        return sql_file, task, config
+
+
+    def network(self, params):
+        """
+        Returns a network in VOSviewer JSON format, as a tuple (key, JSON bytes), where key
+        identifies its inputs. See the module docstring.
+        """
+        sql_file, task, config = self.parse(params)
+        key = BuildManifest.inputs_hash(sql_file, task, config, gbq_dataset_name(self.fulldimensions), **self.options)
+        body = self.cache.get(key)
+        if body is not None:
+            return key, body
+
+        with self.lock:
+            future = self.pending.get(key)
+            first = future is None
+            if first:
+                future = self.pending[key] = Future()
+
+        if first:
+            try:
+                # it may have been added while we were waiting for the lock
+                body = self.cache.get(key)
+                if body is None:
+                    body = self.generate(key, sql_file, task, config)
+                future.set_result(body)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.pending[key]
+        return key, future.result()
+
+
+    def generate(self, key, sql_file, task, config):
+        """Generates a network into the cache, once a job slot is available, and returns its JSON."""
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise ApiError(503, "Too many networks are being generated: try again later")
+        try:
+            printDebug(f"Generating on demand: {os.path.basename(sql_file)} / {task}", "comment")
+            try:
+                data = gen_network(task, sql_file, config, self.fulldimensions, self.verbose, self.cache_mode, self.max_bytes,
+                                   backend=self.backend, snapshot_path=self.snapshot_path)
+            except SendQueryError as e:
+                if e.over_budget:
+                    raise ApiError(422, f"The queries of this network would process more than the limit of the server ({format_bytes(self.max_bytes)}, see --max-bytes)") from None
+                raise
+            node_label, link_label = NETWORK_LABELS[task]
+            path = self.cache.file(key)
+            if self.clustering or needs_network(config):
+                network = build_network(data, task, config, layout=False, clustering=self.clustering)
+                nodes = render_json(network, node_label, link_label, sql_file, path=path, **self.render_options)[0]
+            else:
+                nodes = stream_json(data, task, node_label, link_label, sql_file, path=path, **self.render_options)[0]
+            if not nodes:
+                with open(path, "wb") as output:
+                    output.write(EMPTY_NETWORK)
+            return self.cache.add(key)
+        finally:
+            self.slots.release()
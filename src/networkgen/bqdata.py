@@ -2,7 +2,59 @@
 Helper functions for interacting with BigQuery library
 """
 
+from collections import namedtuple
+import hashlib
+import json
+import os
+import threading
+import time
+
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import bigquery
+from google.cloud.bigquery.table import Row
+import pyarrow
+import pyarrow.parquet as pq
+
+from requests.adapters import HTTPAdapter
+
+from ..settings import DEFAULT_CACHE_PATH, QUERY_CACHE_TTL, QUERY_CACHE_MAX_SIZE, BQ_HTTP_POOL_SIZE
+
+try:
+  # optional: much faster downloads of large results, via the BigQuery Storage Read API
+  from google.cloud import bigquery_storage
+except ImportError:
+  bigquery_storage = None
+
+
+# BigQuery column types => Arrow types (anything else is inferred from the values)
+ARROW_TYPES = {
+  "STRING": pyarrow.string(),
+  "INTEGER": pyarrow.int64(),
+  "INT64": pyarrow.int64(),
+  "FLOAT": pyarrow.float64(),
+  "FLOAT64": pyarrow.float64(),
+  "NUMERIC": pyarrow.decimal128(38, 9),
+  "BOOLEAN": pyarrow.bool_(),
+  "BOOL": pyarrow.bool_(),
+}
+
+
+def _batch_rows(batch):
+  """Yields the contents of an Arrow record batch as BigQuery Row() objects."""
+  field_to_index = {name: i for i, name in enumerate(batch.schema.names)}
+  columns = [column.to_pylist() for column in batch.columns]
+  for values in zip(*columns):
+    yield Row(values, field_to_index)
+
+
+def _rows_batch(rows, bq_schema):
+  """Converts a list of BigQuery Row() objects into an Arrow record batch."""
+  arrays = [
+    pyarrow.array([row[i] for row in rows], type=ARROW_TYPES.get(field.field_type))
+    for i, field in enumerate(bq_schema)
+  ]
+  return pyarrow.RecordBatch.from_arrays(arrays, names=[field.name for field in bq_schema])
 
 
 
@@ -16,10 +68,17 @@ class SendQueryError(Exception):
   """
 
   def __init__(self, message, query, params):
+    super().__init__(message)
     self.message = message
     self.query = query
     self.params = params
 
+  @property
+  def over_budget(self):
+    """True if BigQuery rejected the query because it would bill more than `max_bytes_billed`."""
+    errors = getattr(self.message, "errors", None) or []
+    return any(e.get("reason") == "bytesBilledLimitExceeded" for e in errors if isinstance(e, dict))
+
 
 
 class SendFileError(Exception):
@@ -33,14 +92,215 @@ class SendFileError(Exception):
     self.message = message
 
 
+class QueryCache:
+  """On-disk cache of query results.
+
+  Entries are content-addressed: the key is a hash of the final SQL text,
+  the query parameters and the dataset being queried. Results are stored
+  as Parquet files, so they stay compact and keep their column names.
+
+  Attributes:
+    path -- the folder where cached results are stored
+    ttl -- seconds after which an entry is considered stale
+    max_size -- maximum size of the cache folder, in bytes. Once it is
+      exceeded, the least recently used entries are deleted.
+  """
+
+  extension = ".parquet"
+
+  def __init__(self, path=DEFAULT_CACHE_PATH, ttl=QUERY_CACHE_TTL, max_size=QUERY_CACHE_MAX_SIZE):
+    self.path = path
+    self.ttl = ttl
+    self.max_size = max_size
+
+  @staticmethod
+  def key(q, params=None, dataset=None):
+    """Returns the cache key for a query, its parameters and the dataset."""
+    payload = json.dumps([
+      q,
+      [[str(x) for x in p] for p in (params or [])],
+      dataset,
+    ])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+  def _file(self, key):
+    return os.path.join(self.path, f"{key}{self.extension}")
+
+  def _touch(self, key):
+    """Returns the file cached for a key, or None if missing or stale.
+
+    The entry is marked as recently used, by updating its access time (the
+    modification time keeps track of when it was created). Entries can be
+    evicted at any time by another thread or process: this is a cache miss.
+    """
+    filename = self._file(key)
+    try:
+      stat = os.stat(filename)
+      if self.ttl is not None and time.time() - stat.st_mtime > self.ttl:
+        return None
+      os.utime(filename, (time.time(), stat.st_mtime))
+    except FileNotFoundError:
+      return None
+    return filename
+
+  def open(self, key):
+    """Returns the Parquet file cached for a key, or None if missing or stale."""
+    filename = self._touch(key)
+    if filename is None:
+      return None
+    try:
+      return pq.ParquetFile(filename)
+    except FileNotFoundError:
+      return None
+
+  def get(self, key):
+    """Returns the cached rows for a key, or None if missing or stale."""
+    cached = self.open(key)
+    if cached is None:
+      return None
+    return [row for batch in cached.iter_batches() for row in _batch_rows(batch)]
+
+  def iter_rows(self, key):
+    """Returns an iterator over the cached rows for a key, or None if missing or stale.
+
+    Rows are read one Parquet batch at a time, so that memory use does
+    not grow with the size of the results.
+    """
+    cached = self.open(key)
+    if cached is None:
+      return None
+    return (row for batch in cached.iter_batches() for row in _batch_rows(batch))
+
+  def put(self, key, names, rows):
+    """Stores a list of rows under a key, then enforces the size limit."""
+    table = pyarrow.table({
+      name: [row[i] for row in rows] for i, name in enumerate(names)
+    })
+    for batch in self.put_batches(key, table.to_batches(), table.schema):
+      pass
+
+  def put_batches(self, key, batches, schema):
+    """Stores Arrow record batches under a key, as they are consumed.
+
+    This is a generator yielding back each batch once it has been written,
+    so that results can be cached while they are being streamed. The entry
+    is only added to the cache once all batches have been consumed.
+
+    Parameters:
+      key (str) -- The cache key.
+      batches (iterable) -- Arrow record batches.
+      schema (pyarrow.Schema) -- Used when there are no batches at all.
+    """
+    os.makedirs(self.path, exist_ok=True)
+    filename = self._file(key)
+    # write to a temporary file first, so that readers never see a partial entry
+    tmp = f"{filename}.{os.getpid()}.{id(batches)}.tmp"
+    writer = None
+    try:
+      for batch in batches:
+        if writer is None:
+          writer = pq.ParquetWriter(tmp, batch.schema)
+        writer.write_table(pyarrow.Table.from_batches([batch]))
+        yield batch
+      if writer is None:
+        writer = pq.ParquetWriter(tmp, schema)
+      writer.close()
+      writer = None
+      os.replace(tmp, filename)
+      self.evict()
+    finally:
+      if writer is not None:
+        writer.close()
+      if os.path.exists(tmp):
+        os.remove(tmp)
+
+  def evict(self):
+    """Deletes the least recently used entries until the cache fits in max_size."""
+    if self.max_size is None or not os.path.isdir(self.path):
+      return
+    entries = []
+    for f in os.listdir(self.path):
+      if f.endswith(self.extension):
+        try:
+          stat = os.stat(os.path.join(self.path, f))
+        except FileNotFoundError:
+          continue  # evicted by another job in the meantime
+        entries.append((stat.st_atime, stat.st_size, f))
+    total = sum(x[1] for x in entries)
+    for atime, size, f in sorted(entries):
+      if total <= self.max_size:
+        break
+      try:
+        os.remove(os.path.join(self.path, f))
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  def clear(self):
+    """Deletes all entries in the cache."""
+    if os.path.isdir(self.path):
+      for f in os.listdir(self.path):
+        if f.endswith(self.extension):
+          os.remove(os.path.join(self.path, f))
+
+
+
+# Timings of a BigQuery job run by a Client. Times are in seconds.
+JobTiming = namedtuple("JobTiming", [
+  "label",       # what the job was for, if the caller said so
+  "job_id",
+  "queued",      # from job creation to start
+  "running",     # from job start to end
+  "total",       # from submission to results available, as seen by the client
+  "bytes_processed",
+  "bytes_billed",
+  "cache_hit",   # True if BigQuery served the results from its own cache
+])
+
+
+
+_SHARED_CLIENT = None
+_SHARED_CLIENT_LOCK = threading.Lock()
+
+
+def get_client(verbose=False, pool_size=None):
+  """Returns the process-wide Client, creating it on first use.
+
+  Credentials discovery and HTTP connections setup happen only once,
+  and connections are then reused by all queries, including those run
+  concurrently from different threads.
+
+  Parameters:
+    verbose (bool) -- Turns on verbose mode (it is never turned off).
+    pool_size (int) -- Maximum number of HTTP connections kept open.
+      Only used when the client is first created.
+  """
+  global _SHARED_CLIENT
+  with _SHARED_CLIENT_LOCK:
+    if _SHARED_CLIENT is None:
+      _SHARED_CLIENT = Client(pool_size=pool_size)
+    _SHARED_CLIENT.verbose = _SHARED_CLIENT.verbose or verbose
+    return _SHARED_CLIENT
+
+
+
 class Client:
   
-  def __init__(self, project=None, verbose=False):
-    self.client = bigquery.Client()
+  def __init__(self, project=None, verbose=False, cache=None, pool_size=None):
+    credentials, default_project = google.auth.default(scopes=bigquery.Client.SCOPE)
+    # a single HTTP session, with a pool large enough to be shared by concurrent queries
+    pool_size = pool_size or BQ_HTTP_POOL_SIZE
+    session = AuthorizedSession(credentials)
+    session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    self.client = bigquery.Client(project=project or default_project, credentials=credentials, _http=session)
+    self.bqstorage_client = bigquery_storage.BigQueryReadClient(credentials=credentials) if bigquery_storage else None
     self.project = project
     self.verbose = verbose
+    self.cache = cache if cache is not None else QueryCache()
+    self.timings = []
+    self._timings_lock = threading.Lock()
 
-  def send_query(self, q, params=None):
+  def send_query(self, q, params=None, dataset=None, cache_mode="use", stream=False, max_bytes_billed=None, cache_key=None, label=None):
     """Constructs and sends a query to BigQuery.
 
     Parameters:
@@ -50,27 +310,158 @@ class Client:
         be of the format (param_name, type, value). So a string
         parameter might be ("new_param", "STRING", "value_here")
         and an int might be ("new_paramval", "INT64", 250)
+      dataset (str) -- The dataset being queried. Only used as part
+        of the results cache key.
+      cache_mode (str) -- One of "use" (read from and write to the results
+        cache), "refresh" (ignore cached results, but store the new ones)
+        or "off" (bypass the cache entirely).
+      stream (bool) -- If True, wait for the query job to finish, but
+        download its results lazily, one page at a time.
+      max_bytes_billed (int) -- If set, BigQuery fails the job (without
+        charges) if it would bill more bytes than this.
+      cache_key (str) -- Key to use for the results cache, instead of the
+        one computed from the query. Useful when the query refers to
+        temporary tables, whose names change on every run.
+      label (str) -- Describes the query in the job timings.
 
     Returns:
       results (list) -- A list of BigQuery Row() objects, which can
-        be unpacked like a dictionary.
+        be unpacked like a dictionary. If `stream` is True, an iterator
+        over the same Row() objects.
+    """
+    key = cache_key or QueryCache.key(q, params, dataset)
+    if cache_mode == "use":
+      rows = self.cache.iter_rows(key) if stream else self.cache.get(key)
+      if rows is not None:
+        if self.verbose:
+          print(f'---\nQUERY RESULTS LOADED FROM CACHE: {key}\n---\n')
+        return rows
+
+    try:
+      start = time.time()
+      job_config = self._job_config(params)
+      if max_bytes_billed is not None:
+        job_config.maximum_bytes_billed = int(max_bytes_billed)
+      query_job = self.client.query(q, job_config=job_config)  # Make an API request.
+      if self.verbose:
+        print(f'---\nQUERY\n {query_job.query} \n---\n')
+
+      result = query_job.result()
+      self._add_timing(query_job, start, label)
+      if stream:
+        return self._stream_rows(result, key if cache_mode != "off" else None, q, params)
+      rows = [x for x in result]
+
+    except Exception as x:
+      raise SendQueryError(x, q, params)
+
+    if cache_mode != "off":
+      self.cache.put(key, [field.name for field in result.schema], rows)
+    return rows
+
+
+  def materialize_query(self, q, params=None, max_bytes_billed=None, label=None):
+    """Runs a query and leaves its results in BigQuery, without downloading them.
+
+    The results are stored by BigQuery in a temporary table (kept for about
+    24 hours), which can be referenced by subsequent queries.
+
+    Returns:
+      table (str) -- The full name of the table holding the results,
+        e.g. my-project._1234abcd.anon5678
+    """
+    try:
+      start = time.time()
+      job_config = self._job_config(params)
+      if max_bytes_billed is not None:
+        job_config.maximum_bytes_billed = int(max_bytes_billed)
+      query_job = self.client.query(q, job_config=job_config)
+      query_job.result()
+      self._add_timing(query_job, start, label)
+    except Exception as x:
+      raise SendQueryError(x, q, params)
+    table = query_job.destination
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+  def is_cached(self, q, params=None, dataset=None):
+    """Returns True if the results of a query are available in the results cache."""
+    return self.cache.open(QueryCache.key(q, params, dataset)) is not None
+
+
+  def estimate_query(self, q, params=None):
+    """Runs a query as a dry run, which is free and does not execute it.
+
+    Parameters:
+      q (str) -- The query to be estimated.
+      params (list) -- Query parameters, see send_query.
+
+    Returns:
+      bytes (int) -- How many bytes BigQuery would process to run the query.
+    """
+    try:
+      job_config = self._job_config(params, dry_run=True, use_query_cache=False)
+      query_job = self.client.query(q, job_config=job_config)
+    except Exception as x:
+      raise SendQueryError(x, q, params)
+    return query_job.total_bytes_processed or 0
+
+
+  def _add_timing(self, query_job, start, label=None):
+    """Records the timings of a finished job."""
+    def seconds(t0, t1):
+      return (t1 - t0).total_seconds() if t0 and t1 else None
+
+    timing = JobTiming(
+      label,
+      query_job.job_id,
+      seconds(query_job.created, query_job.started),
+      seconds(query_job.started, query_job.ended),
+      time.time() - start,
+      query_job.total_bytes_processed,
+      query_job.total_bytes_billed,
+      query_job.cache_hit,
+    )
+    with self._timings_lock:
+      self.timings.append(timing)
+    if self.verbose:
+      print(f'---\nJOB TIMINGS\n {timing} \n---\n')
+
+
+  def _job_config(self, params=None, **kwargs):
+    """Returns a QueryJobConfig for a list of parameter tuples (see send_query).
+
+    Any other keyword arguments are passed on to QueryJobConfig.
+    """
+    if params is not None:
+      #bigquery.ScalarQueryParameter("min_word_count", "INT64", 250)
+      kwargs["query_parameters"] = [bigquery.ScalarQueryParameter(*x) for x in params]
+    return bigquery.QueryJobConfig(**kwargs)
+
+
+  def _stream_rows(self, result, key=None, q=None, params=None):
+    """Yields the rows of a finished query job, downloading them one page at a time.
+
+    If the BigQuery Storage library is installed, pages are read as Arrow
+    record batches through the Storage Read API. If a cache key is passed,
+    the batches are also written to the results cache as they arrive.
+
+    Errors while downloading the pages are raised as SendQueryError, for the
+    query `q` and its `params`, like errors while running the query.
     """
     try:
-      if params is None:
-        query_job = self.client.query(q)  # Make an API request.
+      if self.bqstorage_client is not None:
+        batches = result.to_arrow_iterable(bqstorage_client=self.bqstorage_client)
       else:
-        #bigquery.ScalarQueryParameter("min_word_count", "INT64", 250)
-        job_config = bigquery.QueryJobConfig(
-          query_parameters=[bigquery.ScalarQueryParameter(*x) for x in params]
-        )
-        query_job = self.client.query(q, job_config=job_config)
-        if self.verbose:
-          print(f'---\nQUERY\n {query_job.query} \n---\n')
+        batches = (_rows_batch(list(page), result.schema) for page in result.pages)
+
+      if key is not None:
+        batches = self.cache.put_batches(key, batches, _rows_batch([], result.schema).schema)
 
+      for batch in batches:
+        yield from _batch_rows(batch)
     except Exception as x:
       raise SendQueryError(x, q, params)
-    else:
-      return [x for x in query_job]
 
 
   def send_data(self, file, table_id, schema=None):
@@ -0,0 +1,170 @@
+"""
+Index pages of the website, for catalogues of any size:
+
+  - SITE_TOPICS_MANIFEST: the metadata of all topics (network parameters, number of
+    nodes and edges, file sizes and build time of each network), as compact JSON.
+  - Index pages listing INDEX_PAGE_SIZE topics each: `index.html`, `index-2.html`, etc.
+    The SQL of a topic is not part of the page: it is loaded when its card is expanded.
+  - SITE_SEARCH_INDEX: the words of the topic names and queries, each with the topics
+    containing it, so that the browser can search all topics without loading them.
+    It is only downloaded when the search box is used (see index.js).
+
+so that the size of each page, hence its load time, doesn't depend on the number of topics.
+"""
+
+import html
+import json
+import os
+import re
+from collections import defaultdict
+
+from ..settings import *
+from .helpers import *
+from .manifest import BuildManifest
+from .writers import export_extensions
+
+
+
+def topic_title(topic):
+    """Returns the name of a topic as displayed in the index, e.g. `herd-immunity` => `Herd immunity`."""
+    return topic.replace("_", " ").replace("-", " ").capitalize()
+
+
+
+def page_name(page):
+    """Returns the file name of an index page (numbered from 1)."""
+    return "index.html" if page == 1 else f"index-{page}.html"
+
+
+
+def topic_catalogue(page_size=INDEX_PAGE_SIZE):
+    """
+    Returns the metadata of the topics that have both SQL and JSON files, sorted by name,
+    as a list of dicts (see SITE_TOPICS_MANIFEST).
+    """
+    entries = BuildManifest().entries
+    catalogue = []
+    for n, sql in enumerate(sorted(get_valid_topics())):
+        topic, sql_file = sql[:-len(".sql")], f"{DEFAULT_TOPICS_SQL_PATH}/{sql}"
+        networks = {}
+        for task in NETWORK_TYPES:
+            key = BuildManifest.key(sql_file, task)
+            if not os.path.exists(f"{DEFAULT_TOPICS_JSON_PATH}/{key}"):
+                continue
+            entry = entries.get(key, {})
+            files = {}
+            for f in entry.get("files", [key]):
+                # only the files of the website (see publish.site_files)
+                if os.path.exists(f"{DEFAULT_TOPICS_JSON_PATH}/{f}") and not f.endswith(export_extensions()):
+                    files[f"topics/json/{f}"] = os.path.getsize(f"{DEFAULT_TOPICS_JSON_PATH}/{f}")
+            networks[task] = {
+                "nodes": entry.get("nodes"),
+                "edges": entry.get("edges"),
+                "built": entry.get("built"),
+                "files": files,
+            }
+        catalogue.append({
+            "id": topic,
+            "title": topic_title(topic),
+            "sql": f"topics/{sql}",
+            "sql_size": os.path.getsize(sql_file),
+            "parameters": extract_query_metadata(sql_file),
+            "networks": networks,
+            "page": n // page_size + 1,
+        })
+    return catalogue
+
+
+
+def search_index(catalogue):
+    """
+    Returns the search index of a catalogue: {"topics": [[id, title, sql path, network types]],
+    "terms": {word: [positions in topics]}}, with the words of each topic name and query.
+    """
+    terms = defaultdict(set)
+    for i, topic in enumerate(catalogue):
+        with open(f"{DEFAULT_TOPICS_SQL_PATH}/{os.path.basename(topic['sql'])}", "r") as input:
+            # without the network parameters, e.g. `-- max_nodes: 400`
+            sql = [l for l in input if not (l.startswith("--") and any(f"{p}:" in l for p in NETWORK_PARAMETERS_DEFAULT))]
+        text = f"{topic['id']} {''.join(sql)}".lower()
+        for word in re.findall(r"[a-z0-9]+", text):
+            if len(word) >= SEARCH_INDEX_MIN_LENGTH and word not in SEARCH_INDEX_STOPWORDS:
+                terms[word].add(i)
+    return {
+        "topics": [[x["id"], x["title"], x["sql"], list(x["networks"])] for x in catalogue],
+        "terms": {word: sorted(topics) for word, topics in sorted(terms.items())},
+    }
+
+
+
+def topic_card(topic):
+    """Returns the HTML card of a topic in the index."""
+    links, stats = [], []
+    for task, network in topic["networks"].items():
+        url = f"wrapper.html?topicId={topic['id']}&network={task}"
+        links.append(f"<a href='{html.escape(url)}' target='_blank'>{task.capitalize()}</a>")
+        if network["nodes"] is not None:
+            stats.append(f"{task.capitalize()}: {network['nodes']:,} nodes, {network['edges']:,} links")
+    url = f"wrapper.html?topicId={topic['id']}&network={next(iter(topic['networks']), NETWORK_TYPES[0])}"
+    card = f"""<div class="col-md-6"><div class="card">"""
+    card += f"<h6 class='card-header'>Topic: <a href='{html.escape(url)}' target='_blank'>{html.escape(topic['title'])}</a></h6>"
+    card += f"""<div class="card-body"><small>Networks: {" | ".join(links)}"""
+    if stats:
+        card += f"""<br />{html.escape(" / ".join(stats))}"""
+    card += f"""</small><details class="topic-query" data-sql="{html.escape(topic['sql'])}"><summary><small>Query</small></summary><pre></pre></details>"""
+    card += """</div></div></div>"""
+    return card
+
+
+
+def pagination(page, pages, window=INDEX_PAGINATION_WINDOW):
+    """Returns the navigation links of an index page: first, previous, nearby, next and last pages."""
+    if pages <= 1:
+        return ""
+
+    def item(label, target, active=False, disabled=False):
+        state = " active" if active else " disabled" if disabled else ""
+        return f"""<li class="page-item{state}"><a class="page-link" href="{page_name(target)}">{label}</a></li>"""
+
+    items = [item("&laquo;", max(page - 1, 1), disabled=page == 1)]
+    nearby = range(max(page - window, 1), min(page + window, pages) + 1)
+    if nearby[0] > 1:
+        items.append(item(1, 1))
+        if nearby[0] > 2:
+            items.append(item("&hellip;", page, disabled=True))
+    items += [item(n, n, active=n == page) for n in nearby]
+    if nearby[-1] < pages:
+        if nearby[-1] < pages - 1:
+            items.append(item("&hellip;", page, disabled=True))
+        items.append(item(pages, pages))
+    items.append(item("&raquo;", min(page + 1, pages), disabled=page == pages))
+    return f"""<nav><ul class="pagination justify-content-center">{"".join(items)}</ul></nav>"""
+
+
+
+def index_pages(catalogue, page_size=INDEX_PAGE_SIZE):
+    """
+    Returns the index pages of a catalogue, as a dict of file name => HTML, combining
+    "index_template.html" with the cards and navigation links of each page.
+    """
+    with open(f'{PROJECT_STATIC_PATH}/index_template.html', "r") as input:
+        template = input.read()
+    if not catalogue:
+        return {"index.html": template.replace('<!-- BODY HERE -->', "<em>(No network definitions were found.)</em>")}
+
+    pages = (len(catalogue) - 1) // page_size + 1
+    result = {}
+    for page in range(1, pages + 1):
+        topics = catalogue[(page - 1) * page_size:page * page_size]
+        body = "".join(topic_card(x) for x in topics)
+        result[page_name(page)] = template.replace('<!-- BODY HERE -->', body).replace('<!-- PAGINATION HERE -->', pagination(page, pages))
+    return result
+
+
+
+def index_files(catalogue):
+    """Returns all the generated files of the index, as a dict of path in the website => contents."""
+    files = index_pages(catalogue)
+    files[SITE_TOPICS_MANIFEST] = json.dumps({"page_size": INDEX_PAGE_SIZE, "topics": catalogue}, sort_keys=True, separators=(",", ":"))
+    files[SITE_SEARCH_INDEX] = json.dumps(search_index(catalogue), separators=(",", ":"))
+    return files
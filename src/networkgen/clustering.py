@@ -0,0 +1,120 @@
+"""
+Network clustering: assigns the nodes of a network to clusters when building it, so
+that the viewer doesn't have to run the clustering algorithm in the browser (where
+results can change from one visit to the next).
+
+Uses the Louvain algorithm for modularity optimization (see Blondel, Guillaume,
+Lambiotte, Lefebvre (2008), "Fast unfolding of communities in large networks",
+J. Stat. Mech. P10008), on a scipy sparse adjacency matrix:
+  1. local moving: each node is moved to the neighbouring cluster giving the largest
+     increase in modularity, until no node moves;
+  2. aggregation: each cluster becomes a node of a new network (A' = C^T A C),
+and so on until clusters don't change anymore.
+
+Nodes are visited in a fixed order, so the same network always gets the same clusters.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from ..settings import *
+from .helpers import *
+
+
+
+def adjacency_matrix(n_nodes, source, target, weight):
+    """Returns the symmetric adjacency matrix of a network, as a CSR matrix."""
+    A = sparse.coo_matrix((weight.astype(np.float64), (source, target)), shape=(n_nodes, n_nodes))
+    return (A + A.T).tocsr()
+
+
+
+def modularity(A, clusters, resolution=CLUSTERING_RESOLUTION):
+    """Returns the modularity of a partition of a network, given its adjacency matrix."""
+    degree = np.asarray(A.sum(axis=1)).ravel()
+    two_m = degree.sum()
+    if two_m == 0:
+        return 0.0
+    coo = A.tocoo()
+    internal = coo.data[clusters[coo.row] == clusters[coo.col]].sum()
+    totals = np.bincount(clusters, degree)
+    return (internal - resolution * (totals ** 2).sum() / two_m) / two_m
+
+
+
+def local_moving(A, resolution=CLUSTERING_RESOLUTION, max_passes=CLUSTERING_MAX_PASSES):
+    """
+    Runs the local moving phase of the Louvain algorithm, starting from singleton clusters.
+    Returns the cluster of each node, as consecutive integers.
+    """
+    n = A.shape[0]
+    indptr, indices, data = A.indptr, A.indices, A.data
+    degree = np.asarray(A.sum(axis=1)).ravel()
+    two_m = degree.sum()
+    clusters = np.arange(n)
+    totals = degree.copy() # total degree of the nodes in each cluster
+
+    for _ in range(max_passes):
+        moved = 0
+        for i in range(n):
+            neighbours = indices[indptr[i]:indptr[i + 1]]
+            weights = data[indptr[i]:indptr[i + 1]]
+            not_self = neighbours != i
+            neighbours, weights = neighbours[not_self], weights[not_self]
+            current = clusters[i]
+            totals[current] -= degree[i]
+
+            # weight of the links to each neighbouring cluster, including the current one
+            candidates, inverse = np.unique(np.append(clusters[neighbours], current), return_inverse=True)
+            links = np.bincount(inverse, np.append(weights, 0))
+            gains = links - resolution * totals[candidates] * degree[i] / two_m
+            best = candidates[np.argmax(gains)]
+            # only move when strictly better than staying
+            if gains[np.searchsorted(candidates, current)] >= gains.max():
+                best = current
+
+            totals[best] += degree[i]
+            if best != current:
+                clusters[i] = best
+                moved += 1
+        if not moved:
+            break
+
+    return np.unique(clusters, return_inverse=True)[1]
+
+
+
+def louvain(A, resolution=CLUSTERING_RESOLUTION):
+    """
+    Clusters a network with the Louvain algorithm. Returns the cluster of each node, numbered
+    from 1 by decreasing cluster size (as in VOSviewer).
+    """
+    n = A.shape[0]
+    clusters = np.arange(n)
+    while True:
+        level = local_moving(A, resolution)
+        if level.max() + 1 == A.shape[0]:
+            # no two nodes were merged: done
+            break
+        clusters = level[clusters]
+        # aggregate: one node per cluster, with the links between clusters (and self-loops)
+        C = sparse.csr_matrix((np.ones(len(level)), (np.arange(len(level)), level)), shape=(len(level), level.max() + 1))
+        A = (C.T @ A @ C).tocsr()
+
+    # number clusters by decreasing size, ties broken by their first node
+    sizes = np.bincount(clusters)
+    first = np.full(len(sizes), n)
+    np.minimum.at(first, clusters, np.arange(n))
+    order = np.lexsort((first, -sizes))
+    rank = np.empty(len(sizes), dtype=np.int64)
+    rank[order] = np.arange(1, len(sizes) + 1)
+    return rank[clusters]
+
+
+
+def network_clusters(network):
+    """Returns the cluster number of each node of a Network."""
+    A = adjacency_matrix(network.n_nodes, network.source, network.target, network.weight)
+    clusters = louvain(A)
+    printDebug(f"  Clusters: {clusters.max() if len(clusters) else 0} (modularity {modularity(A, clusters - 1):.3f})", "comment")
+    return clusters
@@ -0,0 +1,116 @@
+"""
+Precompressed website assets: for each large file of the website (network JSON
+files, JS bundles) writes `.gz` and `.br` siblings, so that they can be served
+compressed without compressing them on each request.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import gzip
+import hashlib
+import json
+import os
+
+from ..settings import *
+from .helpers import *
+
+try:
+  # optional: brotli files are smaller than gzip ones, and supported by all modern browsers
+  import brotli
+except ImportError:
+  brotli = None
+
+
+
+def compressed_encodings():
+    """Returns the available encodings, as (encoding, file extension) tuples, by order of preference."""
+    encodings = [("gzip", ".gz")]
+    if brotli is not None:
+        encodings.insert(0, ("br", ".br"))
+    return encodings
+
+
+
+def compress_file(path, encoding):
+    """Writes the compressed version of a file next to it, eg `network.json.gz`. Returns its path."""
+    extension = dict(compressed_encodings())[encoding]
+    with open(path, "rb") as input:
+        data = input.read()
+    if encoding == "br":
+        data = brotli.compress(data, quality=PRECOMPRESS_BROTLI_QUALITY)
+    else:
+        # mtime=0: the same input always gives the same output
+        data = gzip.compress(data, compresslevel=PRECOMPRESS_GZIP_LEVEL, mtime=0)
+    outpath = path + extension
+    tmp = f"{outpath}.tmp"
+    with open(tmp, "wb") as output:
+        output.write(data)
+    os.replace(tmp, outpath)
+    return outpath
+
+
+
+def file_hash(path):
+    """Returns the sha256 hash of a file contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as input:
+        for chunk in iter(lambda: input.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+
+def precompress_website(root=DEFAULT_BUILD_PATH, patterns=PRECOMPRESS_PATTERNS, max_workers=None):
+    """
+    Writes compressed siblings for all files of the website matching `patterns`.
+
+    Files are compressed in parallel (zlib and brotli release the GIL). The hash of each
+    source file is recorded in PRECOMPRESS_MANIFEST: files that have not changed since
+    they were last compressed are skipped. Compressed files whose source no longer exists
+    are deleted.
+
+    Returns the number of files compressed.
+    """
+    manifest_path = f"{root}/{PRECOMPRESS_MANIFEST}"
+    try:
+        with open(manifest_path, "r") as input:
+            manifest = json.load(input)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+
+    encodings = compressed_encodings()
+    extensions = [ext for _, ext in encodings]
+    sources = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for f in filenames:
+            path = os.path.join(dirpath, f)
+            relpath = os.path.relpath(path, root)
+            if f.endswith((".gz", ".br")):
+                if not os.path.exists(path[:-3]):
+                    os.remove(path)
+            elif any(fnmatch.fnmatch(relpath, p) for p in patterns) and os.path.getsize(path) >= PRECOMPRESS_MIN_SIZE:
+                sources.append(relpath)
+
+    def compress(relpath):
+        path = f"{root}/{relpath}"
+        digest = file_hash(path)
+        if manifest.get(relpath) == digest and all(os.path.exists(path + ext) for ext in extensions):
+            return relpath, digest, False
+        for encoding, _ in encodings:
+            compress_file(path, encoding)
+        return relpath, digest, True
+
+    compressed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for relpath, digest, done in executor.map(compress, sources):
+            manifest[relpath] = digest
+            compressed += done
+
+    manifest = {k: v for k, v in manifest.items() if k in sources}
+    with open(manifest_path, "w") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+
+    printInfo(f"  Compressed {compressed} files ({len(sources) - compressed} unchanged): {', '.join(e for e, _ in encodings)}", "comment")
+    if brotli is None:
+        printDebug("  (install `brotli` to generate .br files too)", "comment")
+    return compressed
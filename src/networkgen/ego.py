@@ -0,0 +1,175 @@
+"""
+Ego networks: the neighbourhood of one node of a built network, for the `/api/ego` endpoint
+of the web server (see server.py), e.g.
+
+    /api/ego?topic=herd-immunity&type=concepts&node=vaccination&depth=1&top=20
+
+returns the `top` strongest neighbours of the node (with `depth=2`, also the `top` strongest
+neighbours of each of them), and all the links between these nodes, in VOSviewer JSON
+format: a few KB, instead of the whole network.
+
+Network files are read from the website folder once, into an adjacency index (see
+Adjacency), and read again when they change.
+"""
+
+import glob
+import json
+import os
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+from ..settings import *
+from .helpers import *
+from .api import ApiError
+from .network import merge_links
+
+
+
+class Adjacency:
+    """
+    A VOSviewer JSON network, with its links indexed by node: the neighbours of node `i` are
+    neighbours[indptr[i]:indptr[i + 1]], from the strongest link to the weakest, and
+    link_ids gives the (position of the) link to each of them.
+    """
+
+    def __init__(self, data):
+        self.config = data.get("config", {})
+        self.items = data["network"]["items"]
+        self.links = data["network"].get("links", [])
+        ids = {item["id"]: i for i, item in enumerate(self.items)}
+        self.by_label = {item.get("label", str(item["id"])): i for i, item in enumerate(self.items)}
+        self.by_id = {str(item["id"]): i for i, item in enumerate(self.items)}
+        self.by_lower_label = {label.lower(): i for label, i in self.by_label.items()}
+
+        n_links = len(self.links)
+        source = np.fromiter((ids[x["source_id"]] for x in self.links), np.int64, n_links)
+        target = np.fromiter((ids[x["target_id"]] for x in self.links), np.int64, n_links)
+        strength = np.fromiter((x.get("strength", 1) for x in self.links), np.float64, n_links)
+        # older files list some links in both directions (see merge_links)
+        source, target = np.minimum(source, target), np.maximum(source, target)
+        link_ids, strength = merge_links(source, target, strength, len(self.items))
+        source, target = source[link_ids], target[link_ids]
+
+        # each link in both directions, sorted by node then by decreasing strength
+        nodes = np.concatenate([source, target])
+        neighbours = np.concatenate([target, source])
+        order = np.lexsort((-np.concatenate([strength, strength]), nodes))
+        self.neighbours, self.link_ids = neighbours[order], np.concatenate([link_ids, link_ids])[order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(nodes[order], minlength=len(self.items)))])
+
+
+    def find(self, node):
+        """Returns the index of a node given its label (or ID), or None."""
+        for lookup, key in ((self.by_label, node), (self.by_id, node), (self.by_lower_label, node.lower())):
+            if key in lookup:
+                return lookup[key]
+        return None
+
+
+    def ego(self, center, depth=1, top=API_EGO_TOP):
+        """
+        Returns the nodes around `center` (see the module docstring), center first, and the
+        links between them, as two lists of indices.
+        """
+        nodes, frontier = [center], [center]
+        seen = {center}
+        for _ in range(depth):
+            expanded = []
+            for i in frontier:
+                for j in self.neighbours[self.indptr[i]:self.indptr[i] + top].tolist():
+                    if j not in seen:
+                        seen.add(j)
+                        expanded.append(j)
+            nodes += expanded
+            frontier = expanded
+
+        member = np.zeros(len(self.items), dtype=bool)
+        member[nodes] = True
+        links = [self.link_ids[self.indptr[i]:self.indptr[i + 1]][member[self.neighbours[self.indptr[i]:self.indptr[i + 1]]]] for i in nodes]
+        return nodes, np.unique(np.concatenate(links)).tolist()
+
+
+    def ego_json(self, center, depth=1, top=API_EGO_TOP):
+        """Returns the ego network of `center`, in VOSviewer JSON format (bytes)."""
+        nodes, links = self.ego(center, depth, top)
+        return json.dumps({
+            "config": self.config,
+            "network": {
+                "items": [self.items[i] for i in nodes],
+                "links": [self.links[k] for k in links],
+            },
+        }).encode()
+
+
+
+class EgoIndex:
+    """
+    The Adjacency of the networks of a website folder, loaded on first use (or all at once
+    with `load_all`), and reloaded when their file changes.
+    """
+
+    def __init__(self, directory=DEFAULT_BUILD_PATH):
+        self.path = f"{directory}/topics/json"
+        self.networks = {}  # (topic, type) => ((mtime, size) of the file, Adjacency)
+        self.locks = defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+
+    def get(self, topic, task):
+        """Returns the Adjacency of a network. Raises ApiError if there is no such network."""
+        if not re.fullmatch(r"[\w\-]+", topic) or task not in NETWORK_TYPES:
+            raise ApiError(404, f"Unknown network: {topic!r} / {task!r}")
+        path = f"{self.path}/{task}/{topic}.json"
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            raise ApiError(404, f"Unknown network: {topic!r} / {task!r}") from None
+
+        key, signature = (topic, task), (stat.st_mtime_ns, stat.st_size)
+        entry = self.networks.get(key)
+        if entry is None or entry[0] != signature:
+            with self.lock:
+                lock = self.locks[key]
+            with lock:
+                entry = self.networks.get(key)
+                if entry is None or entry[0] != signature:
+                    with open(path, "r") as input:
+                        entry = self.networks[key] = (signature, Adjacency(json.load(input)))
+        return entry[1]
+
+
+    def load_all(self):
+        """Loads all the networks of the folder, e.g. when starting the server."""
+        for path in sorted(glob.glob(f"{self.path}/*/*.json")):
+            task, topic = path.split("/")[-2], os.path.basename(path)[:-len(".json")]
+            if "." in topic:
+                continue  # levels of detail
+            try:
+                self.get(topic, task)
+            except Exception as e:
+                printDebug(f"Could not index {path}: {e}", "red")
+
+
+    def ego(self, params):
+        """
+        Returns the ego network of a request (see the module docstring), as a tuple
+        (key, JSON bytes). Raises ApiError for unknown nodes or invalid parameters.
+        """
+        unknown = set(params) - {"topic", "type", "node", "depth", "top"}
+        if unknown:
+            raise ApiError(400, f"Unknown parameters: {', '.join(sorted(unknown))}")
+        try:
+            depth, top = int(params.get("depth", 1)), int(params.get("top", API_EGO_TOP))
+        except ValueError:
+            raise ApiError(400, "depth and top must be integers") from None
+        if depth not in (1, 2) or not 0 < top <= API_EGO_MAX_TOP:
+            raise ApiError(400, f"Expected depth=1 or 2, and 0 < top <= {API_EGO_MAX_TOP}")
+
+        adjacency = self.get(params.get("topic", ""), params.get("type", ""))
+        center = adjacency.find(params.get("node", ""))
+        if center is None:
+            raise ApiError(404, f"Unknown node: {params.get('node', '')!r}")
+        return f"{params['topic']}/{params['type']}/{center}/{depth}/{top}", adjacency.ego_json(center, depth, top)
@@ -7,9 +7,10 @@ Helper functions for networkgen library
 from collections import defaultdict
 import configparser
 import os
+import re
 import subprocess
-from shutil import copytree, ignore_patterns
 import click
+from google.auth.exceptions import DefaultCredentialsError
 
 from ..settings import *
 from . import bqdata
@@ -18,30 +19,34 @@ from . import bqdata
 
 
 
-def _test_user_login():
+def _test_user_login(pool_size=None):
     """
     Returns a boolean value indicating whether the user
     is currently authenticated to the Google Cloud Platform
     API.
+
+    If so, the shared BigQuery client used by the whole process is set up too.
     """
     try:
-        db = bqdata.Client()
-    except OSError as x:
+        db = bqdata.get_client(pool_size=pool_size)
+    except (OSError, DefaultCredentialsError) as x:
         return False
     return True
 
 
 
-def user_login():
+def user_login(pool_size=None):
     """
     Handles the process of logging a user into GCP via
     the gcloud command-line tool. Does not return anything,
     but does exit if the `gcloud` command cannot be found
     on the local machine.
+
+    pool_size: max number of HTTP connections of the shared BigQuery client.
     """
 
     # If they're already logged in, we're good:
-    if _test_user_login():
+    if _test_user_login(pool_size):
         printDebug('Gcloud credentials found. Skipping login.', "comment")
         return
 
@@ -97,7 +102,7 @@ def set_up_env(verbose=True):
     for task in NETWORK_TYPES:
         json_files = os.listdir(f'{DEFAULT_TOPICS_JSON_PATH}/{task}')
         for f in json_files:
-            f_sql = f.replace(".json", ".sql")
+            f_sql = json_sql_file(f)
             if not os.path.exists(f"{DEFAULT_TOPICS_SQL_PATH}/{f_sql}"):
                 os.remove(f'{DEFAULT_TOPICS_JSON_PATH}/{task}/{f}')
                 printInfo(f"\t..deleted {DEFAULT_TOPICS_JSON_PATH}/{task}/{f}", "comment")   
@@ -108,6 +113,14 @@ def set_up_env(verbose=True):
 
 
 
+def json_sql_file(f):
+    """Returns the name of the SQL topic file a network file was generated from.
+    E.g. `topic.json`, `topic.links-1000.json`, `topic.levels.json` and `topic.edges.csv` all come from `topic.sql`.
+    """
+    return re.sub(r"(\.links-\d+|\.levels|\.nodes|\.edges)?\.(json|graphml|gexf|csv|parquet)$", ".sql", f)
+
+
+
 def get_valid_topics():
     """List the topics that have both SQL and JSON files
     """
@@ -116,7 +129,7 @@ def get_valid_topics():
         json_files = os.listdir(f'{DEFAULT_TOPICS_JSON_PATH}/{task}')
         for f in json_files:
             if f.endswith(".json"):
-                f_sql = f.replace(".json", ".sql")
+                f_sql = json_sql_file(f)
                 if os.path.exists(f"{DEFAULT_TOPICS_SQL_PATH}/{f_sql}"):
                     topics += [f_sql] 
 
@@ -125,61 +138,22 @@ def get_valid_topics():
 
 
 
-def build_website():
+def build_website(hardlink=False):
     """
     Generates the website listing out all available science maps.
-    Combines input data with "index_template.html" to generate
-    a file called "index.html".
+    Combines input data with "index_template.html" to generate the
+    index pages "index.html", "index-2.html" etc, see catalogue.py.
 
+    The pages are published together with the HTML static files and all TOPICS SQL and JSON,
+    as a new release of the website: see publish.py (`hardlink`: link new files instead of copying them).
     """
     printInfo("Generating website pages..")
 
-    # copy all HTML static files
-    copytree(PROJECT_STATIC_PATH, DEFAULT_BUILD_PATH, dirs_exist_ok=True, ignore=ignore_patterns('index_template.html',))
-
-    # copy all TOPICS SQL and JSON
-    copytree(DEFAULT_TOPICS_SQL_PATH, DEFAULT_BUILD_TOPICS_PATH, dirs_exist_ok=True)
-
-    # valid topics are sql files that have a json dataset as well
-    valid_topics = [x.replace(".sql", "") for x in get_valid_topics()]
-    DEFAULT_NETWORK_TYPE = NETWORK_TYPES[0]
-
-    def get_sqlquery_contents(topic):
-        try:
-            with open(f"{DEFAULT_BUILD_TOPICS_PATH}/{topic}.sql", "r") as input:
-                return input.read()
-        except:
-            printInfo(f"  => SQL query for topic '{topic}' not found in {DEFAULT_BUILD_TOPICS_PATH}")
-            return "No SQL found"
-
-    if len(valid_topics) > 0:
-        body = ""
-        for topic in sorted(valid_topics):
-            body += """<div class="col-md-6"><div class="card"> """
-            topic_nice = topic.replace("_", " ").replace("-", " ").capitalize()
-            # body += f"<h6 class='card-header'>Topic: <span style='color: darkred'>{topic_nice}</span></h6>"
-            
-            _url = f"wrapper.html?topicId={topic}&network={DEFAULT_NETWORK_TYPE}"
-            body += f"<h6 class='card-header'>Topic: <a href='{_url}' target='_blank'>{topic_nice}</a></h6>"
-            body += """<div class="card-body"><small>Query:</small> <br /><br />"""
-
-            sql = get_sqlquery_contents(topic)
-            body += f"""<pre>{sql}</pre></div></div></div>"""
-
-        body += ""
-
-    else:
-        body = "<em>(No network definitions were found.)</em>"
-
-    with open(f'{PROJECT_STATIC_PATH}/index_template.html', "r") as input:
-        template = input.read()
-    template = template.replace('<!-- BODY HERE -->', body)
-
-    outpath = f'{DEFAULT_BUILD_PATH}/index.html'
-    with open(outpath, "w") as output:
-        output.write(template)
-
-    printInfo(f"  Saved: {outpath}", "comment")
+    from .catalogue import topic_catalogue, index_files
+    from .publish import publish_website
+    catalogue = topic_catalogue()
+    printInfo(f"  Topics in the index: {len(catalogue)}", "comment")
+    publish_website(index_files(catalogue), hardlink=hardlink)
 
 
 
@@ -270,6 +244,33 @@ REGEXP_CONTAINS(title.preferred, r'$key')
 
 
 
+def canonical_edges(rows, nodes=None):
+    """
+    Yields the links of an undirected network in canonical form: (node1, node2, weight)
+    tuples where node1 < node2.
+
+    The network queries return each pair of nodes only once (they group the links by pair, and
+    keep only one order of the two nodes), so duplicates are not looked for here: that would take
+    memory in proportion to the number of links, instead of the number of nodes. They are merged
+    when building a Network (see merge_links); the streaming writers assume canonical input.
+
+    Inputs:
+        - rows (iterable): (node1, node2, weight) rows, e.g. as returned by BigQuery.
+        - nodes (dict): Node table, mapping each node to a dense integer ID. Nodes are added
+            to it as they are found, so that callers can reuse it.
+    """
+    nodes = {} if nodes is None else nodes
+    for node1, node2, weight in rows:
+        if node2 < node1:
+            node1, node2 = node2, node1
+        nodes.setdefault(node1, len(nodes))
+        nodes.setdefault(node2, len(nodes))
+        yield node1, node2, int(weight)
+
+
+
+
+
 
 #
 #
@@ -279,6 +280,27 @@ REGEXP_CONTAINS(title.preferred, r'$key')
 
 
 
+def parse_size(size):
+    """Parses a size in bytes, optionally using a unit suffix eg "500MB", "1.5TB" (multiples of 1024).
+    """
+    units = {"KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4, "B": 1}
+    size = str(size).strip().upper()
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)].strip()) * multiplier)
+    return int(size)
+
+
+def format_bytes(n):
+    """Formats a number of bytes in a human readable way eg "1.2 GB".
+    """
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(n) < 1024 or unit == "TB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{n} B"
+        n /= 1024
+
+
+
 def printDebug(text, mystyle="", err=True, **kwargs):
     """Wrapper around click.secho() for printing in colors with various defaults.
 
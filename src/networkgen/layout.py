@@ -0,0 +1,206 @@
+"""
+Network layout: computes the coordinates of the nodes when building a network, so
+that the viewer doesn't have to run the layout algorithm in the browser.
+
+Uses the VOS mapping technique, as VOSviewer does (see van Eck, Waltman, Dekker,
+van den Berg (2010), "A comparison of two techniques for bibliometric mapping:
+Multidimensional scaling and VOS", JASIST 61 (12)). Nodes are placed so as to minimize
+
+    V(x) = sum_ij s_ij d_ij^a / a - sum_ij d_ij^r / r
+
+where d_ij is the distance between two nodes, s_ij the association strength of their
+link, and a, r the attraction and repulsion parameters. The minimization uses the
+same gradient descent with step size adaptation as VOSviewer, on dense matrices.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from ..settings import *
+from .helpers import *
+
+
+
+def association_strength(n_nodes, source, target, weight):
+    """
+    Returns the (dense, symmetric) matrix of the association strengths of the links:
+    s_ij = 2m a_ij / (k_i k_j), where k_i is the total weight of node i and m the
+    total weight of the network.
+    """
+    total = np.bincount(source, weight, n_nodes) + np.bincount(target, weight, n_nodes)
+    S = np.zeros((n_nodes, n_nodes))
+    np.add.at(S, (source, target), weight)
+    S = S + S.T
+    return S * total.sum() / np.outer(total, total).clip(min=1)
+
+
+
+def _squared_distances(x):
+    """Returns the matrix of the squared distances between all pairs of points (ones on the diagonal)."""
+    sq = (x ** 2).sum(axis=1)
+    d2 = (sq[:, None] + sq[None, :] - 2 * x @ x.T).clip(min=0)
+    np.fill_diagonal(d2, 1)
+    return d2
+
+
+
+def _power(d, p):
+    """d^p, using multiplications for small integer exponents (much faster than np.power)."""
+    if p == 0:
+        return 1.0
+    if p != int(p) or abs(p) > 8:
+        return d ** p
+    result = d
+    for _ in range(abs(int(p)) - 1):
+        result = result * d
+    return 1 / result if p < 0 else result
+
+
+
+class _Distances:
+    """The distances between the nodes of a layout, and their powers used by the VOS objective and its gradient."""
+
+    def __init__(self, x, attraction, repulsion):
+        d2 = _squared_distances(x)
+        d = np.sqrt(d2)
+        self.attraction = _power(d, attraction - 2) # d^(a-2)
+        self.repulsion = _power(d, repulsion - 2) # d^(r-2)
+        if repulsion == 0:
+            self.repulsion_term = np.log(d).sum()
+        else:
+            self.repulsion_term = (self.repulsion * d2).sum() / repulsion
+        self.d2 = d2
+
+
+    def objective(self, S, attraction):
+        """The VOS objective function (up to a constant, from the diagonal)."""
+        return (S * self.attraction * self.d2).sum() / attraction - self.repulsion_term
+
+
+
+def _vos(S, attraction, repulsion, max_iterations, seed):
+    """Lays out a connected network, given its matrix of association strengths."""
+    n = len(S)
+    x = np.random.RandomState(seed).uniform(-1, 1, (n, 2))
+    d = _Distances(x, attraction, repulsion)
+
+    step, progress, value = 1.0, 0, d.objective(S, attraction)
+    for _ in range(max_iterations):
+        if step < LAYOUT_MIN_STEP:
+            break
+        # gradient: sum_j (s_ij d_ij^(a-2) - d_ij^(r-2)) (x_i - x_j)
+        M = S * d.attraction - d.repulsion
+        np.fill_diagonal(M, 0)
+        gradient = x * M.sum(axis=1)[:, None] - M @ x
+        norm = np.linalg.norm(gradient, axis=1)[:, None]
+        x = x - step * gradient / np.where(norm > 0, norm, 1)
+        d = _Distances(x, attraction, repulsion)
+
+        new_value = d.objective(S, attraction)
+        if new_value < value:
+            progress += 1
+            if progress >= 5:
+                progress = 0
+                step /= LAYOUT_STEP_REDUCTION
+        else:
+            progress = 0
+            step *= LAYOUT_STEP_REDUCTION
+        value = new_value
+
+    return x
+
+
+
+def vos_layout(n_nodes, source, target, weight, attraction=LAYOUT_ATTRACTION, repulsion=LAYOUT_REPULSION,
+               max_iterations=LAYOUT_MAX_ITERATIONS, seed=LAYOUT_SEED):
+    """
+    Computes the coordinates of the nodes of a network with the VOS mapping technique.
+
+    As the objective function has no minimum when the network is not connected (its components
+    would move away from each other indefinitely), each connected component is laid out
+    separately, as in VOSviewer. Components are then arranged in rows, by decreasing size.
+
+    Inputs:
+      - n_nodes (int): number of nodes.
+      - source, target, weight (arrays): the links, as indices of nodes and weights.
+      - attraction, repulsion: parameters of the layout (as in the VOSviewer viewer).
+      - max_iterations (int): maximum number of gradient descent iterations.
+      - seed (int): seed of the random initial positions. The same network always gets the same layout.
+
+    Returns an array of (x, y) coordinates, standardized: centered on (0, 0), with an average
+    distance of 1 between nodes, and the principal axis of each component horizontal.
+    """
+    if attraction <= repulsion:
+        raise ValueError("The attraction parameter of the layout must be greater than the repulsion parameter.")
+
+    S = association_strength(n_nodes, source, target, weight)
+    n_components, component = connected_components(sparse.csr_matrix(S), directed=False)
+    # largest components first, ties broken by their first node
+    members = sorted((np.flatnonzero(component == c) for c in range(n_components)), key=lambda x: (-len(x), x[0]))
+
+    layouts = []
+    for nodes in members:
+        if len(nodes) < 2:
+            layouts.append(np.zeros((len(nodes), 2)))
+        else:
+            x = _vos(S[np.ix_(nodes, nodes)], attraction, repulsion, max_iterations, seed)
+            # smaller components are drawn smaller, with about the same space between nodes
+            layouts.append(standardize(x) * np.sqrt(len(nodes) / len(members[0])))
+
+    x = np.zeros((n_nodes, 2))
+    for nodes, coordinates in zip(members, _arrange(layouts)):
+        x[nodes] = coordinates
+    return standardize(x, rotate=n_components == 1)
+
+
+
+def _arrange(layouts):
+    """Places layouts next to each other in rows, in order, in a roughly square area. Returns the moved layouts."""
+    boxes = [x.max(axis=0) - x.min(axis=0) if len(x) else np.zeros(2) for x in layouts]
+    margin = 0.1 * max(boxes[0].max(), 1e-6)
+    row_width = max(boxes[0][0], np.sqrt(sum((w + margin) * (h + margin) for w, h in boxes)))
+
+    arranged = []
+    left, top, row_height = 0.0, 0.0, 0.0
+    for x, (w, h) in zip(layouts, boxes):
+        if left > 0 and left + w > row_width:
+            left, top, row_height = 0.0, top - row_height - margin, 0.0
+        arranged.append(x - (x.min(axis=0) if len(x) else 0) + [left, top - h])
+        left += w + margin
+        row_height = max(row_height, h)
+    return arranged
+
+
+
+def standardize(x, rotate=True):
+    """
+    Centers a layout, scales it to an average distance of 1 between nodes, and (with `rotate`)
+    rotates its principal axis horizontally.
+    """
+    x = x - x.mean(axis=0)
+    n = len(x)
+    if n > 1:
+        d2 = _squared_distances(x)
+        np.fill_diagonal(d2, 0)
+        mean_distance = np.sqrt(d2).sum() / (n * (n - 1))
+        if mean_distance > 0:
+            x = x / mean_distance
+        if rotate:
+            _, vectors = np.linalg.eigh(x.T @ x)
+            x = x @ vectors[:, ::-1]
+            # fix the orientation of the axes, which the eigenvectors leave undetermined
+            x = x * np.where(np.sum(x ** 3, axis=0) < 0, -1, 1)
+    return x
+
+
+
+def network_layout(network):
+    """
+    Returns the (x, y) coordinates of the nodes of a Network, or None if it has more than
+    LAYOUT_MAX_NODES nodes (the layout is then left to the viewer).
+    """
+    if network.n_nodes > LAYOUT_MAX_NODES:
+        printDebug(f"  Layout skipped: more than {LAYOUT_MAX_NODES} nodes.", "comment")
+        return None
+    return vos_layout(network.n_nodes, network.source, network.target, network.weight).round(4)
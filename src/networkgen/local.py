@@ -0,0 +1,268 @@
+"""
+Local backend: computes networks from a snapshot of the publications table,
+instead of running the network queries in BigQuery.
+
+The snapshot is a folder containing:
+  - `publications.parquet` (or `publications.jsonl`), with fields `id`, `year`,
+    `concepts` (a list of {concept, relevance}) and `research_orgs` (a list of GRID IDs).
+  - `grid.parquet` (or `grid.jsonl`), with fields `id` and `name`.
+
+For example, it can be extracted from BigQuery with:
+
+    SELECT id, year, concepts, research_orgs FROM `covid-19-dimensions-ai.data.publications`
+    SELECT id, name FROM `covid-19-dimensions-ai.data.grid`
+
+Co-occurrences are computed as sparse matrix products of the publication/concept
+(and publication/organization) incidence matrices, giving the same results as the
+BigQuery queries in networkgen.py.
+"""
+
+import os
+import threading
+
+import numpy as np
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.json
+import pyarrow.parquet as pq
+from scipy import sparse
+
+from . import bqdata
+from ..settings import *
+from .helpers import *
+
+
+
+class LocalSnapshot:
+    """
+    Publications data loaded in memory, as incidence matrices.
+
+    Attributes:
+      - pub_ids (dict): publication ID => row index
+      - years (array): publication year, per row (-1 if missing)
+      - concepts (list): concept names, per column of the concepts matrices
+      - concepts_pubs, concepts_cols, concepts_relevance (arrays): one entry per
+        publication/concept pair, in COO format
+      - orgs (list): GRID IDs, per column of the organizations matrix
+      - orgs_matrix (csr_matrix): publications x organizations incidence matrix
+      - grid_names (dict): GRID ID => organization name
+    """
+
+    def __init__(self, path):
+        printDebug(f'Loading publications snapshot: {path}', "comment")
+        pubs = _read_table(path, "publications")
+
+        ids = pubs.column("id").to_pylist()
+        self.pub_ids = {x: i for i, x in enumerate(ids)}
+        self.years = pc.fill_null(pubs.column("year"), -1).to_numpy()
+
+        # concepts: flatten the lists of {concept, relevance} structs
+        concepts = pubs.column("concepts").combine_chunks()
+        self.concepts_pubs = pc.list_parent_indices(concepts).to_numpy()
+        flat = pc.list_flatten(concepts)
+        concept_field, relevance_field = flat.type.get_field_index("concept"), flat.type.get_field_index("relevance")
+        self.concepts, self.concepts_cols = _factorize(pc.struct_field(flat, [concept_field]))
+        self.concepts_relevance = pc.fill_null(pc.cast(pc.struct_field(flat, [relevance_field]), pyarrow.float64()), -1).to_numpy()
+
+        # organizations
+        orgs = pubs.column("research_orgs").combine_chunks()
+        orgs_pubs = pc.list_parent_indices(orgs).to_numpy()
+        self.orgs, orgs_cols = _factorize(pc.list_flatten(orgs))
+        self.orgs_matrix = sparse.csr_matrix(
+            (np.ones(len(orgs_cols), dtype=np.int64), (orgs_pubs, orgs_cols)),
+            shape=(len(ids), len(self.orgs)),
+        )
+
+        grid = _read_table(path, "grid")
+        self.grid_names = dict(zip(grid.column("id").to_pylist(), grid.column("name").to_pylist()))
+
+        printDebug(f'  Publications: {len(ids)}. Concepts: {len(self.concepts)}. Organizations: {len(self.orgs)}.', "comment")
+
+
+    def subset_weights(self, subset_ids):
+        """
+        Returns an array with, for each publication, how many times its ID appears in the subset.
+        IDs missing from the snapshot are ignored.
+        """
+        weights = np.zeros(len(self.pub_ids), dtype=np.int64)
+        for x in subset_ids:
+            i = self.pub_ids.get(x)
+            if i is not None:
+                weights[i] += 1
+        return weights
+
+
+    def concept_network(self, subset_ids, config):
+        """
+        Returns the concept co-occurrence links for a subset of publications, as a list
+        of (concept_a, concept_b, overlap) tuples. Same logic as concept_network_query.
+        """
+        min_relevance = float(config['min_concept_relevance'])
+        min_frequency = int(config['min_concept_frequency'])
+        max_nodes = int(config['max_nodes'])
+        min_edge_weight = int(config['min_edge_weight'])
+
+        weights = self.subset_weights(subset_ids)
+        # publications are joined to the subset: duplicate subset IDs count multiple times
+        keep = (self.years[self.concepts_pubs] >= 1965) & (self.concepts_relevance >= min_relevance) & (weights[self.concepts_pubs] > 0)
+        A = sparse.csr_matrix(
+            (np.ones(keep.sum(), dtype=np.int64), (self.concepts_pubs[keep], self.concepts_cols[keep])),
+            shape=(len(self.pub_ids), len(self.concepts)),
+        )
+        W = sparse.diags(weights, dtype=np.int64)
+
+        # papercount / filtered
+        papers = np.asarray(A.T @ weights).ravel()
+        top = _top_nodes(papers, self.concepts, max_nodes, min_frequency)
+
+        # results: concept pairs co-occurring in the same publications
+        A = A[:, top]
+        overlap = (A.T @ W @ A).tocoo()
+        links = overlap.data >= min_edge_weight
+        names = [self.concepts[i] for i in top]
+        return [
+            (names[i], names[j], int(n))
+            for i, j, n in zip(overlap.row[links], overlap.col[links], overlap.data[links])
+            if names[i] < names[j]
+        ]
+
+
+    def orgs_collab_network(self, subset_ids, config):
+        """
+        Returns the organizations collaboration links for a subset of publications, as a list
+        of (org1, org2, collabs) tuples. Same logic as orgs_collab_network_query.
+        """
+        max_nodes = int(config['max_nodes'])
+        min_edge_weight = int(config['min_edge_weight'])
+
+        # publications are filtered with `IN subset`: duplicate subset IDs count once
+        in_subset = (self.subset_weights(subset_ids) > 0).astype(np.int64)
+        S = sparse.diags(in_subset, dtype=np.int64)
+
+        # top_nodes
+        pubs = np.asarray(self.orgs_matrix.T @ in_subset).ravel()
+        top = _top_nodes(pubs, self.orgs, max_nodes)
+        # organizations missing from GRID are dropped by the join with it
+        top = np.array([i for i in top if self.orgs[i] in self.grid_names], dtype=np.int64)
+
+        # links: COUNT(DISTINCT p.id), hence a binary incidence matrix
+        B = (self.orgs_matrix[:, top] > 0).astype(np.int64)
+        collabs = (B.T @ S @ B).tocoo()
+        org_ids = [self.orgs[i] for i in top]
+        labels = [f"{self.grid_names[x]} ({x})" for x in org_ids]
+        return [
+            (labels[i], labels[j], int(n))
+            for i, j, n in zip(collabs.row, collabs.col, collabs.data)
+            if org_ids[i] > org_ids[j] and n >= min_edge_weight
+        ]
+
+
+
+def _read_table(path, name):
+    """Reads `name`.parquet or `name`.jsonl from a snapshot folder, as an Arrow table."""
+    if os.path.exists(f"{path}/{name}.parquet"):
+        return pq.read_table(f"{path}/{name}.parquet")
+    elif os.path.exists(f"{path}/{name}.jsonl"):
+        return pyarrow.json.read_json(f"{path}/{name}.jsonl")
+    raise FileNotFoundError(f"Snapshot table not found: {path}/{name}.parquet (or .jsonl)")
+
+
+def _factorize(values):
+    """Returns the distinct values of an Arrow array, and the index of each element in them."""
+    encoded = pc.dictionary_encode(values).combine_chunks() if isinstance(values, pyarrow.ChunkedArray) else pc.dictionary_encode(values)
+    return encoded.dictionary.to_pylist(), encoded.indices.to_numpy(zero_copy_only=False)
+
+
+def _top_nodes(counts, names, max_nodes, min_count=1):
+    """
+    Returns the indices of the `max_nodes` items with the highest counts, among those
+    with at least `min_count`. Ties are broken by name, so that results are stable.
+    """
+    candidates = np.flatnonzero(counts >= max(min_count, 1))
+    if len(candidates) > max_nodes:
+        # only sort the items that can make it to the top
+        threshold = np.partition(counts[candidates], -max_nodes)[-max_nodes]
+        candidates = candidates[counts[candidates] >= threshold]
+    ranked = sorted(candidates, key=lambda i: (-counts[i], names[i]))
+    return np.array(ranked[:max_nodes], dtype=np.int64)
+
+
+
+_SNAPSHOTS = {}
+_SNAPSHOTS_LOCK = threading.Lock()
+
+
+def snapshot_files(path):
+    """
+    Returns the size and modification time of the tables of a snapshot folder, as a dict of
+    file name => [size, mtime_ns], so that changes to the snapshot can be detected (e.g. when refreshed in place).
+    """
+    files = {}
+    for name in ("publications", "grid"):
+        for ext in ("parquet", "jsonl"):
+            f = f"{path}/{name}.{ext}"
+            if os.path.exists(f):
+                stat = os.stat(f)
+                files[f"{name}.{ext}"] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+
+def load_snapshot(path):
+    """Returns the LocalSnapshot for a folder, loading it only once per process, unless its files change."""
+    path = os.path.abspath(path)
+    files = snapshot_files(path)
+    with _SNAPSHOTS_LOCK:
+        if path not in _SNAPSHOTS or _SNAPSHOTS[path][0] != files:
+            _SNAPSHOTS[path] = (files, LocalSnapshot(path))
+        return _SNAPSHOTS[path][1]
+
+
+
+def subset_query(sql_file):
+    """Returns the query retrieving the publication IDs of a topic."""
+    with open(sql_file, "r") as input:
+        subquery = input.read()
+    return f"SELECT id FROM (\n{subquery}\n)"
+
+
+def subset_ids(sql_file, fulldimensions=False, verbose=False, cache_mode="use", max_bytes=None):
+    """
+    Returns the publication IDs of a topic.
+
+    The topic query still runs in BigQuery, but it only returns IDs and goes through the
+    results cache: once cached, networks can be regenerated offline with any parameters.
+    With `max_bytes`, the query job fails without charges if it would bill more than this.
+    """
+    db = bqdata.get_client(verbose=verbose)
+    rows = db.send_query(
+        subset_query(sql_file),
+        dataset=gbq_dataset_name(fulldimensions),
+        cache_mode=cache_mode,
+        max_bytes_billed=max_bytes,
+        label=f"{os.path.basename(sql_file)} / subset",
+    )
+    return [row[0] for row in rows]
+
+
+
+def gen_local_network(task, sql_file, config, fulldimensions=False, verbose=False, cache_mode="use", snapshot_path=DEFAULT_SNAPSHOT_PATH, max_bytes=None):
+    """
+    Builds a network of type `task` for a topic, using the local snapshot.
+    Returns a list of (node1, node2, weight) tuples, like gen_network.
+    """
+    printDebug(f'Building {task} network from local snapshot..')
+    printDebug(f'  File: {sql_file}', "comment")
+
+    snapshot = load_snapshot(snapshot_path)
+    ids = subset_ids(sql_file, fulldimensions, verbose, cache_mode, max_bytes)
+
+    if task == 'organizations':
+        data = snapshot.orgs_collab_network(ids, config)
+    elif task == 'concepts':
+        data = snapshot.concept_network(ids, config)
+    else:
+        raise ValueError(f"Invalid network type: {task}")
+
+    printDebug('  Network data computed locally.', "comment")
+    return data
@@ -0,0 +1,95 @@
+"""
+Build manifest: keeps track of the inputs used to generate each network file,
+so that only the networks whose inputs have changed get generated again.
+"""
+
+from datetime import datetime
+import hashlib
+import json
+import os
+
+from ..settings import *
+from ..VERSION import __version__
+from .helpers import *
+from .vosviewer import network_json_path
+
+
+
+class BuildManifest:
+    """
+    Records, for each network file, a hash of the inputs it was generated from.
+
+    Inputs are: the contents of the topic SQL file, the network parameters, the
+    dataset, the tool version, and any other options affecting the results (eg
+    the backend used).
+
+    Entries are keyed on the path of the network file, relative to DEFAULT_TOPICS_JSON_PATH,
+    e.g. "concepts/last_30_days.json".
+    """
+
+    def __init__(self, path=DEFAULT_BUILD_MANIFEST):
+        self.path = path
+        try:
+            with open(path, "r") as input:
+                self.entries = json.load(input)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+
+    @staticmethod
+    def key(sql_file, task):
+        """Returns the manifest key for a topic file and network type."""
+        return os.path.relpath(network_json_path(sql_file, task), DEFAULT_TOPICS_JSON_PATH)
+
+
+    @staticmethod
+    def inputs_hash(sql_file, task, metadata, dataset, **options):
+        """Returns a hash of all the inputs used to generate a network."""
+        with open(sql_file, "rb") as input:
+            sql_hash = hashlib.sha256(input.read()).hexdigest()
+        payload = json.dumps({
+            "sql": sql_hash,
+            "task": task,
+            "metadata": metadata,
+            "dataset": dataset,
+            "version": __version__,
+            "options": options,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+    def is_current(self, sql_file, task, inputs_hash):
+        """
+        Returns True if the network was last generated from the same inputs, and its files are
+        still there (unless it was empty, in which case no file is written).
+        """
+        entry = self.entries.get(self.key(sql_file, task))
+        if entry is None or entry["inputs"] != inputs_hash:
+            return False
+        files = entry.get("files", [os.path.relpath(network_json_path(sql_file, task), DEFAULT_TOPICS_JSON_PATH)])
+        return entry["nodes"] == 0 or all(os.path.exists(f"{DEFAULT_TOPICS_JSON_PATH}/{f}") for f in files)
+
+
+    def record(self, sql_file, task, inputs_hash, nodes, edges, files=()):
+        """Records that a network has been generated, into `files` (in any output format)."""
+        self.entries[self.key(sql_file, task)] = {
+            "sql_file": os.path.basename(sql_file),
+            "inputs": inputs_hash,
+            "built": datetime.now().isoformat(timespec="seconds"),
+            "nodes": nodes,
+            "edges": edges,
+            "files": sorted(os.path.relpath(f, DEFAULT_TOPICS_JSON_PATH) for f in files),
+        }
+
+
+    def save(self):
+        """Writes the manifest to disk, dropping the entries whose SQL file no longer exists."""
+        self.entries = {
+            k: v for k, v in self.entries.items()
+            if os.path.exists(f"{DEFAULT_TOPICS_SQL_PATH}/{v['sql_file']}")
+        }
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as output:
+            json.dump(self.entries, output, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,191 @@
+"""
+In-memory representation of a network, shared by the pruning, layout and clustering
+stages and by the writers.
+
+Nodes are stored once, in a table of labels, with their attributes precomputed
+(e.g. the Dimensions search fragment selecting their publications). Links are
+stored as parallel numpy arrays of node IDs and weights.
+"""
+
+from array import array
+
+import numpy as np
+
+from ..settings import *
+from .helpers import *
+
+
+
+class Network:
+    """
+    A network of type `task` (see NETWORK_TYPES).
+
+    Attributes:
+      - labels (list): node labels, by node ID
+      - search (list): Dimensions search URL fragment selecting the publications of each node
+      - grid_ids (list): GRID ID of each node (organizations networks only, otherwise None)
+      - source, target (arrays): node IDs of each link, with labels[source] < labels[target]
+      - weight (array): weight of each link
+      - coordinates (array): optional (x, y) of each node, see layout.py
+      - clusters (array): optional cluster number of each node, see clustering.py
+    """
+
+    def __init__(self, task, labels, source, target, weight, grid_ids=None, coordinates=None, clusters=None):
+        self.task = task
+        self.labels = labels
+        self.source = source
+        self.target = target
+        self.weight = weight
+        self.grid_ids = grid_ids if grid_ids is not None else [grid_id(x) for x in labels] if task == "organizations" else None
+        self.search = [node_search(task, x, self.grid_ids[i] if self.grid_ids else None) for i, x in enumerate(labels)]
+        self.coordinates = coordinates
+        self.clusters = clusters
+
+
+    @classmethod
+    def from_rows(cls, task, rows):
+        """
+        Builds a network from (node1, node2, weight) rows, e.g. as returned by BigQuery.
+        Rows are read one at a time (see canonical_edges), then the links listed more than once,
+        e.g. as both (a, b) and (b, a) by an older cached result or topic query, are merged (see merge_links).
+        """
+        nodes = {}
+        source, target, weight = array('q'), array('q'), array('q')
+        for node1, node2, w in canonical_edges(rows, nodes):
+            source.append(nodes[node1])
+            target.append(nodes[node2])
+            weight.append(w)
+        source, target = np.frombuffer(source, dtype=np.int64), np.frombuffer(target, dtype=np.int64)
+        keep, weight = merge_links(source, target, np.frombuffer(weight, dtype=np.int64), len(nodes))
+        if len(keep) < len(source):
+            printDebug(f"  Warning: merged {len(source) - len(keep)} duplicate links (each pair of nodes should be returned only once).", "red")
+            source, target = source[keep], target[keep]
+        return cls(task, list(nodes), source, target, weight)
+
+
+    @property
+    def n_nodes(self):
+        return len(self.labels)
+
+
+    @property
+    def n_links(self):
+        return len(self.weight)
+
+
+    def degrees(self):
+        """Returns the number of links of each node."""
+        return np.bincount(self.source, minlength=self.n_nodes) + np.bincount(self.target, minlength=self.n_nodes)
+
+
+    def strengths(self):
+        """Returns the total link strength of each node."""
+        return (np.bincount(self.source, self.weight, self.n_nodes) + np.bincount(self.target, self.weight, self.n_nodes)).astype(np.int64)
+
+
+    def link_search(self, i, j):
+        """Returns the Dimensions search URL fragment selecting the publications shared by nodes `i` and `j`."""
+        return link_search(self.task, self.search[i], self.search[j])
+
+
+    def link_search_parts(self):
+        """
+        Returns two lists of strings (left, right) such that the search fragment of the link between
+        nodes `i` and `j` is left[i] + right[j]: links need no string processing of their own.
+        """
+        parts = [link_search_parts(self.task, x) for x in self.search]
+        return [x[0] for x in parts], [x[1] for x in parts]
+
+
+    def subset(self, links):
+        """
+        Returns the network made of some of the links of this one (a boolean mask or an array of
+        indices, in order), and of the nodes having at least one of these links. Nodes keep their
+        attributes and their relative order, and get new consecutive IDs.
+        """
+        source, target, weight = self.source[links], self.target[links], self.weight[links]
+        used = np.zeros(self.n_nodes, dtype=bool)
+        used[source] = used[target] = True
+        kept = np.flatnonzero(used)
+        new_ids = np.cumsum(used) - 1
+
+        network = Network.__new__(Network)
+        network.task = self.task
+        network.labels = [self.labels[i] for i in kept]
+        network.grid_ids = [self.grid_ids[i] for i in kept] if self.grid_ids is not None else None
+        network.search = [self.search[i] for i in kept]
+        network.source, network.target, network.weight = new_ids[source], new_ids[target], weight
+        network.coordinates = self.coordinates[kept] if self.coordinates is not None else None
+        network.clusters = self.clusters[kept] if self.clusters is not None else None
+        return network
+
+
+    def rows(self):
+        """Yields the links as (node1, node2, weight) rows of labels."""
+        labels = self.labels
+        for s, t, w in zip(self.source.tolist(), self.target.tolist(), self.weight.tolist()):
+            yield labels[s], labels[t], w
+
+
+
+def merge_links(source, target, weight, n_nodes):
+    """
+    Merges the links between the same two nodes, given in canonical form (see canonical_edges).
+    Duplicates are the same pair of nodes reported twice, e.g. (a, b) and (b, a): the merged link
+    keeps the strongest weight, and the position of the first one.
+
+    Returns a tuple (positions of the links kept, in order, their weights).
+    """
+    key = source * n_nodes + target
+    unique, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+    if len(unique) == len(key):
+        return np.arange(len(key)), weight
+    merged = np.zeros(len(unique), dtype=weight.dtype)
+    np.maximum.at(merged, inverse, weight)
+    order = np.argsort(first)
+    return first[order], merged[order]
+
+
+
+def grid_id(node):
+    """Returns the GRID ID of an organization node, formatted as eg "King's College London (grid.13097.3c)"."""
+    return node[node.index("grid"):-1]
+
+
+
+def node_search(task, node, grid=None):
+    """
+    Returns the Dimensions search URL fragment (`custom_search`) selecting the publications of a node.
+    """
+    if task == "concepts":
+        return "%20AND%20%22" + node.replace(" ", "%20") + "%22"
+
+    elif task == "organizations":
+        return f"&and_facet_research_org={grid or grid_id(node)}"
+
+
+
+def link_search_parts(task, search):
+    """
+    Returns the parts (left, right) of the search fragment of a node (see node_search) used in the
+    search fragments of its links: link_search(task, search1, search2) == left1 + right2.
+    """
+    if task == "concepts":
+        return search[:-3] + "%20AND%20", search[len("%20AND%20%22"):]
+    return search, search
+
+
+
+def link_search(task, search1, search2):
+    """
+    Returns the Dimensions search URL fragment selecting the publications shared by two nodes,
+    given their own search fragments (see node_search).
+    """
+    if task == "concepts":
+        # %20AND%20%22concept1%22 + %20AND%20%22concept2%22 => %20AND%20%22concept1%20AND%20concept2%22
+        return search1[:-3] + "%20AND%20" + search2[len("%20AND%20%22"):]
+
+    elif task == "organizations":
+        return search1 + search2
+
+    return "http://www.app.dimensions.ai"
@@ -1,12 +1,107 @@
 from collections import defaultdict
+import itertools
+import os
+import threading
+import time
 
 from . import bqdata
+from . import local
 from ..settings import *
 from .helpers import *
 
 
 
-def gen_orgs_collab_network(sql_file, config, fulldimensions=False, verbose=False):
+def gen_network(task, sql_file, config, fulldimensions=False, verbose=False, cache_mode="use", max_bytes=None, materialize=False, backend="bigquery", snapshot_path=DEFAULT_SNAPSHOT_PATH):
+    """
+    Builds a network of type `task` (one of NETWORK_TYPES) for a topic.
+    See gen_orgs_collab_network and gen_concept_network.
+
+    With the 'local' backend, the network is computed from a snapshot of the publications
+    table instead, see local.gen_local_network.
+    """
+    if backend == 'local':
+        return local.gen_local_network(task, sql_file, config, fulldimensions, verbose, cache_mode, snapshot_path, max_bytes)
+    elif task == 'organizations':
+        return gen_orgs_collab_network(sql_file, config, fulldimensions, verbose, cache_mode, max_bytes, materialize)
+    elif task == 'concepts':
+        return gen_concept_network(sql_file, config, fulldimensions, verbose, cache_mode, max_bytes, materialize)
+    else:
+        raise ValueError(f"Invalid network type: {task}")
+
+
+
+def network_query(task, sql_file, config, fulldimensions=False, subset_table=None):
+    """
+    Returns the query and parameters used to build a network of type `task` for a topic,
+    as a tuple (query, params).
+    """
+    if task == 'organizations':
+        return orgs_collab_network_query(sql_file, config, fulldimensions, subset_table)
+    elif task == 'concepts':
+        return concept_network_query(sql_file, config, fulldimensions, subset_table)
+    else:
+        raise ValueError(f"Invalid network type: {task}")
+
+
+
+def estimate_network(task, sql_file, config, fulldimensions=False, verbose=False, cache_mode="use", backend="bigquery"):
+    """
+    Estimates how many bytes BigQuery would process to build a network, via a dry run.
+    With the 'local' backend, only the topic query runs in BigQuery.
+
+    Returns 0 if the results are already in the local cache, as no BigQuery job would run.
+    """
+    db = bqdata.get_client(verbose=verbose)
+    if backend == 'local':
+        q, params = local.subset_query(sql_file), None
+    else:
+        q, params = network_query(task, sql_file, config, fulldimensions)
+    dataset = gbq_dataset_name(fulldimensions)
+    if cache_mode == "use" and db.is_cached(q, params, dataset):
+        return 0
+    return db.estimate_query(q, params)
+
+
+
+# topic subsets already materialized in BigQuery, in this process: (topic query, dataset) => (table name, creation time)
+_SUBSET_TABLES = {}
+_SUBSET_LOCKS = defaultdict(threading.Lock)
+_SUBSET_LOCKS_LOCK = threading.Lock()
+
+
+def materialize_subset(db, sql_file, fulldimensions=False, max_bytes=None):
+    """
+    Runs the topic query in BigQuery once, and returns the name of the temporary table
+    holding the resulting publication IDs.
+
+    Network queries can then join against this table, instead of re-running the topic
+    query (often a full table scan) every time it's used. Subsequent calls for the same
+    topic return the same table, also when called from concurrent jobs, until it is
+    SUBSET_TABLE_TTL seconds old: BigQuery deletes temporary tables after about a day, which
+    long-running processes (`--watch`, `--runserver --api`) can outlive.
+    """
+    with open(sql_file, "r") as input:
+        subquery = input.read()
+
+    key = (subquery, gbq_dataset_name(fulldimensions))
+    with _SUBSET_LOCKS_LOCK:
+        lock = _SUBSET_LOCKS[key]
+
+    with lock:
+        if key not in _SUBSET_TABLES or time.time() - _SUBSET_TABLES[key][1] > SUBSET_TABLE_TTL:
+            printDebug(f'  Materializing topic subset: {sql_file}', "comment")
+            created = time.time()
+            table = db.materialize_query(
+                f"SELECT id FROM (\n{subquery}\n)",
+                max_bytes_billed=max_bytes,
+                label=f"{os.path.basename(sql_file)} / subset",
+            )
+            _SUBSET_TABLES[key] = (table, created)
+        return _SUBSET_TABLES[key][0]
+
+
+
+def gen_orgs_collab_network(sql_file, config, fulldimensions=False, verbose=False, cache_mode="use", max_bytes=None, materialize=False):
     """
     Builds a collaboration network indicating links between organizations
     within the subset of publications defined by the user.
@@ -14,17 +109,52 @@ def gen_orgs_collab_network(sql_file, config, fulldimensions=False, verbose=Fals
     Inputs:
       - sql_file (string): The input filename with the SQL topic query. Full path so that it can be read directly.
       - config (dict): Key-value pairs of configuration values required below.
+      - cache_mode (string): How to use the query results cache. One of CACHE_MODES.
+      - max_bytes (int): If set, the query job fails without charges if it would bill more than this.
+      - materialize (bool): Run the topic query once into a temporary table, shared by all network types.
+
+    Returns an iterator over the network links. Rows are downloaded lazily, so
+    the result can only be consumed once.
     """
 
-    db = bqdata.Client(verbose=verbose)
+    db = bqdata.get_client(verbose=verbose)
     DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
 
-    with open(sql_file, "r") as input:
-        subquery = input.read()
-
     printDebug(f'Building organizations collaboration network..')
     printDebug(f'  File: {sql_file}', "comment")
 
+    q, params = orgs_collab_network_query(sql_file, config, fulldimensions)
+    cache_key = bqdata.QueryCache.key(q, params, DIMENSIONS_DATASET)
+
+    if materialize and not (cache_mode == "use" and db.is_cached(q, params, DIMENSIONS_DATASET)):
+        subset_table = materialize_subset(db, sql_file, fulldimensions, max_bytes)
+        q, params = orgs_collab_network_query(sql_file, config, fulldimensions, subset_table)
+
+    # results are streamed: rows get downloaded while the network is being rendered
+    data = db.send_query(q, params=params, dataset=DIMENSIONS_DATASET, cache_mode=cache_mode, stream=True, max_bytes_billed=max_bytes, cache_key=cache_key, label=f"{os.path.basename(sql_file)} / organizations")
+
+    printDebug('  Network query completed in BigQuery.', "comment")
+
+    return data
+
+
+
+
+def orgs_collab_network_query(sql_file, config, fulldimensions=False, subset_table=None):
+    """
+    Returns the query and parameters used by gen_orgs_collab_network, as a tuple (query, params).
+
+    If `subset_table` is passed, the topic subset is read from that table (see materialize_subset)
+    instead of running the topic query inline.
+    """
+    DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
+
+    if subset_table:
+        subquery = f"SELECT id FROM `{subset_table}`"
+    else:
+        with open(sql_file, "r") as input:
+            subquery = input.read()
+
     # fetch links
     q = f"""
     WITH subset AS (
@@ -82,16 +212,13 @@ def gen_orgs_collab_network(sql_file, config, fulldimensions=False, verbose=Fals
         ("max_nodes", "INT64", config['max_nodes'])
     ]
 
-    data = db.send_query(q, params=params)
-
-    printDebug('  Network data retrieved from BigQuery.', "comment")
+    return q, params
 
-    return data
 
 
 
 
-def gen_concept_network(sql_file, config,  fulldimensions=False, verbose=False):
+def gen_concept_network(sql_file, config,  fulldimensions=False, verbose=False, cache_mode="use", max_bytes=None, materialize=False):
     """
     Builds a concept co-occurrence network indicating links between
     concepts, within the subset of publications defined by the user.
@@ -99,17 +226,52 @@ def gen_concept_network(sql_file, config,  fulldimensions=False, verbose=False):
     Inputs:
       - sql_file: The input filename with the SQL topic query. Full path so that it can be read directly.
       - config (dict): Key-value pairs of configuration values required below.
+      - cache_mode (string): How to use the query results cache. One of CACHE_MODES.
+      - max_bytes (int): If set, the query job fails without charges if it would bill more than this.
+      - materialize (bool): Run the topic query once into a temporary table, shared by all network types.
+
+    Returns an iterator over the network links. Rows are downloaded lazily, so
+    the result can only be consumed once.
     """
 
-    db = bqdata.Client(verbose=verbose)
+    db = bqdata.get_client(verbose=verbose)
     DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
 
-    with open(sql_file, "r") as input:
-        subquery = input.read()
-
     printDebug(f'Building concept co-occurrence network..')
     printDebug(f'  File: {sql_file}', "comment")
 
+    q, params = concept_network_query(sql_file, config, fulldimensions)
+    cache_key = bqdata.QueryCache.key(q, params, DIMENSIONS_DATASET)
+
+    if materialize and not (cache_mode == "use" and db.is_cached(q, params, DIMENSIONS_DATASET)):
+        subset_table = materialize_subset(db, sql_file, fulldimensions, max_bytes)
+        q, params = concept_network_query(sql_file, config, fulldimensions, subset_table)
+
+    # results are streamed: rows get downloaded while the network is being rendered
+    data = db.send_query(q, params=params, dataset=DIMENSIONS_DATASET, cache_mode=cache_mode, stream=True, max_bytes_billed=max_bytes, cache_key=cache_key, label=f"{os.path.basename(sql_file)} / concepts")
+
+    printDebug('  Network query completed in BigQuery.', "comment")
+
+    return data
+
+
+
+
+def concept_network_query(sql_file, config, fulldimensions=False, subset_table=None):
+    """
+    Returns the query and parameters used by gen_concept_network, as a tuple (query, params).
+
+    If `subset_table` is passed, the topic subset is read from that table (see materialize_subset)
+    instead of running the topic query inline.
+    """
+    DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
+
+    if subset_table:
+        subquery = f"SELECT id FROM `{subset_table}`"
+    else:
+        with open(sql_file, "r") as input:
+            subquery = input.read()
+
     # fetch links
     q = f"""
         WITH subset AS (
@@ -144,7 +306,7 @@ def gen_concept_network(sql_file, config,  fulldimensions=False, verbose=False):
         WHERE year >= 1965
             AND concept1.relevance >= @min_link_relevance
             AND concept2.relevance >= @min_link_relevance
-            AND concept1.concept <> concept2.concept
+            AND concept1.concept < concept2.concept -- to prevent dupes
         GROUP BY 1,2
         )
         SELECT *
@@ -160,9 +322,239 @@ def gen_concept_network(sql_file, config,  fulldimensions=False, verbose=False):
         # ("topic", "STRING", topic)
     ]
 
-    data = db.send_query(q, params=params)
+    return q, params
 
-    printDebug('  Network data retrieved from BigQuery.', "comment")
 
-    return data
 
+
+
+#
+#
+# Batched networks: several topics computed with a single BigQuery job
+#
+#
+
+
+
+def gen_network_batch(task, topics, fulldimensions=False, verbose=False, cache_mode="use", max_bytes=None):
+    """
+    Builds networks of type `task` for several topics at once, with a single BigQuery job.
+
+    All topic subsets are tagged with a `topic_id` (their position in `topics`) and combined,
+    so that the publications table is scanned once for all topics, rather than once per topic.
+
+    Inputs:
+      - task (string): One of NETWORK_TYPES.
+      - topics (list): (sql_file, config) tuples, one per topic.
+
+    Returns an iterator over (topic_id, rows) tuples, where rows is an iterator over the network
+    links of that topic. Topics with no links are not included. Results are streamed, so each
+    topic's rows must be consumed before moving on to the next topic.
+    """
+    db = bqdata.get_client(verbose=verbose)
+    DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
+
+    printDebug(f'Building {task} networks for {len(topics)} topics in a single query..')
+    for sql_file, config in topics:
+        printDebug(f'  File: {sql_file}', "comment")
+
+    q = network_batch_query(task, topics, fulldimensions)
+    data = db.send_query(q, dataset=DIMENSIONS_DATASET, cache_mode=cache_mode, stream=True, max_bytes_billed=max_bytes, label=f"{len(topics)} topics / {task}")
+
+    printDebug('  Network query completed in BigQuery.', "comment")
+
+    return split_batch_rows(data)
+
+
+
+def split_batch_rows(rows):
+    """
+    Splits the rows returned by a batched query (sorted by topic_id, in the first column)
+    into (topic_id, rows) tuples, where rows have the same columns as non-batched queries.
+    """
+    for topic_id, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield topic_id, (tuple(row)[1:] for row in group)
+
+
+
+def network_batch_query(task, topics, fulldimensions=False):
+    """
+    Returns the query used to build networks of type `task` for several topics at once.
+    """
+    if task == 'organizations':
+        return orgs_collab_network_batch_query(topics, fulldimensions)
+    elif task == 'concepts':
+        return concept_network_batch_query(topics, fulldimensions)
+    else:
+        raise ValueError(f"Invalid network type: {task}")
+
+
+
+def estimate_network_batch(task, topics, fulldimensions=False, verbose=False, cache_mode="use"):
+    """
+    Estimates how many bytes BigQuery would process to build a batch of networks. See estimate_network.
+    """
+    db = bqdata.get_client(verbose=verbose)
+    q = network_batch_query(task, topics, fulldimensions)
+    if cache_mode == "use" and db.is_cached(q, None, gbq_dataset_name(fulldimensions)):
+        return 0
+    return db.estimate_query(q)
+
+
+
+def _batch_subset_sql(topics):
+    """
+    Returns the SQL combining all topic queries, each one tagged with its topic_id.
+    """
+    subqueries = []
+    for topic_id, (sql_file, config) in enumerate(topics):
+        with open(sql_file, "r") as input:
+            subquery = input.read()
+        subqueries.append(f"SELECT {topic_id} AS topic_id, id FROM (\n{subquery}\n)")
+    return "\nUNION ALL\n".join(subqueries)
+
+
+def _batch_params_sql(topics):
+    """
+    Returns the SQL of a table with the network parameters of each topic_id.
+
+    Parameters are cast to numbers here, as they are inlined in the query.
+    """
+    rows = []
+    for topic_id, (sql_file, config) in enumerate(topics):
+        rows.append(
+            f"STRUCT({topic_id} AS topic_id"
+            f", {int(config['max_nodes'])} AS max_nodes"
+            f", {int(config['min_edge_weight'])} AS min_edge_weight"
+            f", NUMERIC '{float(config['min_concept_relevance'])}' AS min_link_relevance"
+            f", {int(config['min_concept_frequency'])} AS min_concept_frequency)"
+        )
+    return "SELECT * FROM UNNEST([\n    " + ",\n    ".join(rows) + "\n])"
+
+
+
+def orgs_collab_network_batch_query(topics, fulldimensions=False):
+    """
+    Returns the query building the organizations collaboration networks of several topics.
+    Same as orgs_collab_network_query, computed for each topic_id.
+    """
+    DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
+
+    q = f"""
+    WITH subset AS (
+        {_batch_subset_sql(topics)}
+    ),
+    topic_params AS (
+        {_batch_params_sql(topics)}
+    ),
+    subset_ids AS (
+        SELECT DISTINCT topic_id, id
+        FROM subset
+    ),
+    top_nodes AS (
+        SELECT s.topic_id, orgid, COUNT(p.id) AS pubs
+        FROM `{DIMENSIONS_DATASET}.publications` p
+        INNER JOIN subset_ids s ON p.id=s.id
+        CROSS JOIN UNNEST(p.research_orgs) orgid
+        INNER JOIN topic_params tp ON tp.topic_id=s.topic_id
+        GROUP BY s.topic_id, orgid, tp.max_nodes
+        QUALIFY ROW_NUMBER() OVER (PARTITION BY s.topic_id ORDER BY COUNT(p.id) DESC) <= tp.max_nodes
+    ),
+    links AS (
+        SELECT
+        s.topic_id
+        ,CONCAT(
+            g1.name,
+            ' (',
+            org1_id,
+            ')'
+        ) AS org1
+        ,CONCAT(
+            g2.name,
+            ' (',
+            org2_id,
+            ')'
+        ) AS org2
+        ,COUNT(DISTINCT p.id) AS collabs
+        FROM `{DIMENSIONS_DATASET}.publications` p
+        INNER JOIN subset_ids s ON p.id=s.id
+        CROSS JOIN UNNEST(p.research_orgs) org1_id
+        CROSS JOIN UNNEST(p.research_orgs) org2_id
+        INNER JOIN `{DIMENSIONS_DATASET}.grid` g1
+        ON org1_id=g1.id
+        INNER JOIN `{DIMENSIONS_DATASET}.grid` g2
+        ON org2_id=g2.id
+        INNER JOIN top_nodes t1 ON t1.topic_id=s.topic_id AND t1.orgid=org1_id
+        INNER JOIN top_nodes t2 ON t2.topic_id=s.topic_id AND t2.orgid=org2_id
+        WHERE
+        org1_id > org2_id -- to prevent dupes
+        GROUP BY 1,2,3
+    )
+
+    SELECT links.*
+    FROM links
+    INNER JOIN topic_params tp ON tp.topic_id=links.topic_id
+    WHERE collabs >= tp.min_edge_weight
+    ORDER BY links.topic_id
+    """
+
+    return q
+
+
+
+def concept_network_batch_query(topics, fulldimensions=False):
+    """
+    Returns the query building the concept co-occurrence networks of several topics.
+    Same as concept_network_query, computed for each topic_id.
+    """
+    DIMENSIONS_DATASET = gbq_dataset_name(fulldimensions)
+
+    q = f"""
+        WITH subset AS (
+            {_batch_subset_sql(topics)}
+        ),
+        topic_params AS (
+            {_batch_params_sql(topics)}
+        ),
+        papercount AS (
+            SELECT subset.topic_id, concept.concept, COUNT(p.id) AS papers,
+            FROM `{DIMENSIONS_DATASET}.publications` p
+            INNER JOIN subset ON p.id=subset.id
+            INNER JOIN topic_params tp ON tp.topic_id=subset.topic_id
+            CROSS JOIN UNNEST(p.concepts) concept
+            WHERE
+                year >= 1965
+                AND concept.relevance >= tp.min_link_relevance
+            GROUP BY 1,2
+        ),
+        filtered AS (
+            SELECT papercount.*
+            FROM papercount
+            INNER JOIN topic_params tp ON tp.topic_id=papercount.topic_id
+            WHERE papers >= tp.min_concept_frequency
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY papercount.topic_id ORDER BY papers DESC) <= tp.max_nodes
+        ),
+        results AS (
+        SELECT subset.topic_id, concept1.concept AS concept_a, concept2.concept AS concept_b,
+            COUNT(p.id) AS overlap,
+        FROM `{DIMENSIONS_DATASET}.publications` p
+        INNER JOIN subset ON p.id=subset.id
+        INNER JOIN topic_params tp ON tp.topic_id=subset.topic_id
+        CROSS JOIN UNNEST(p.concepts) concept1
+        CROSS JOIN UNNEST(p.concepts) concept2
+        INNER JOIN filtered pcount1 ON concept1.concept=pcount1.concept AND pcount1.topic_id=subset.topic_id
+        INNER JOIN filtered pcount2 ON concept2.concept=pcount2.concept AND pcount2.topic_id=subset.topic_id
+        WHERE year >= 1965
+            AND concept1.relevance >= tp.min_link_relevance
+            AND concept2.relevance >= tp.min_link_relevance
+            AND concept1.concept < concept2.concept -- to prevent dupes
+        GROUP BY 1,2,3
+        )
+        SELECT results.*
+        FROM results
+        INNER JOIN topic_params tp ON tp.topic_id=results.topic_id
+        WHERE overlap >= tp.min_edge_weight
+        ORDER BY results.topic_id
+    """
+
+    return q
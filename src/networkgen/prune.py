@@ -0,0 +1,97 @@
+"""
+Network pruning: reduces the number of links of a network before it is written,
+and selects the links of each level of detail.
+
+Networks are pruned using their arrays of links (see network.py).
+
+Pruning methods (`prune` network parameter):
+  - none: keep all links.
+  - top_k: keep, for each node, its `prune_top_k` strongest links.
+  - top_n: keep the `prune_top_n` strongest links of the network.
+  - backbone: keep the links that are statistically significant for at least one of
+    their nodes, according to the disparity filter, with significance level `prune_alpha`.
+    See Serrano, Boguna, Vespignani (2009), "Extracting the multiscale backbone of
+    complex weighted networks", PNAS 106 (16).
+"""
+
+import numpy as np
+
+from ..settings import *
+from .helpers import *
+
+
+
+def strongest_links(weight, n):
+    """
+    Returns the indices of the `n` strongest links. Ties are broken by link index, so that
+    results are stable.
+    """
+    order = np.lexsort((np.arange(len(weight)), -weight))
+    return np.sort(order[:n])
+
+
+
+def top_k_per_node(source, target, weight, k):
+    """Returns a mask selecting, for each node, its `k` strongest links."""
+    n = len(weight)
+    # one entry per (node, link) incidence, sorted by node then by decreasing weight
+    node = np.concatenate([source, target])
+    link = np.concatenate([np.arange(n), np.arange(n)])
+    order = np.lexsort((link, -np.concatenate([weight, weight]), node))
+    node, link = node[order], link[order]
+    # rank of each link among the links of the same node
+    starts = np.flatnonzero(np.r_[True, node[1:] != node[:-1]])
+    rank = np.arange(len(node)) - np.repeat(starts, np.diff(np.r_[starts, len(node)]))
+    mask = np.zeros(n, dtype=bool)
+    mask[link[rank < k]] = True
+    return mask
+
+
+
+def disparity_filter(source, target, weight, alpha, n_nodes):
+    """
+    Returns a mask selecting the links of the backbone of the network: those whose weight
+    is significant (p-value below `alpha`) compared to the other links of at least one of
+    their nodes, under the null hypothesis that a node's strength is uniformly distributed
+    across its links.
+    """
+    strength = np.bincount(source, weight, n_nodes) + np.bincount(target, weight, n_nodes)
+    degree = np.bincount(source, minlength=n_nodes) + np.bincount(target, minlength=n_nodes)
+    mask = np.zeros(len(weight), dtype=bool)
+    for node in (source, target):
+        k = degree[node]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p_value = (1 - weight / strength[node]) ** (k - 1)
+        # a node with a single link gives no information about its significance
+        mask |= (k > 1) & (p_value < alpha)
+    return mask
+
+
+
+def prune_network(network, config):
+    """
+    Prunes a network according to its `prune` parameter. Returns the network of the links kept
+    (see Network.subset), or the same network if it is not pruned.
+    """
+    method = str(config.get('prune', 'none')).strip()
+    if method == 'none':
+        return network
+    elif method == 'top_k':
+        keep = top_k_per_node(network.source, network.target, network.weight, int(config['prune_top_k']))
+    elif method == 'top_n':
+        keep = strongest_links(network.weight, int(config['prune_top_n']))
+    elif method == 'backbone':
+        keep = disparity_filter(network.source, network.target, network.weight, float(config['prune_alpha']), network.n_nodes)
+    else:
+        raise ValueError(f"Invalid pruning method: {method} (valid methods: {', '.join(PRUNE_METHODS)})")
+
+    pruned = network.subset(keep)
+    printDebug(f"  Pruning ({method}): kept {pruned.n_links} links out of {network.n_links}.", "comment")
+    return pruned
+
+
+
+def detail_levels(config):
+    """Returns the numbers of links of the levels of detail of a network, in increasing order."""
+    levels = str(config.get('detail_levels', '')).replace(",", " ").split()
+    return sorted(set(int(x) for x in levels))
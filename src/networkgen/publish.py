@@ -0,0 +1,155 @@
+"""
+Publishing of the website: instead of copying all files into the build folder on each
+build, a new release of the website is staged in its own folder, then published at once.
+
+  - `build` is a symlink to the current release, in `build-releases/`. Publishing a new
+    release replaces the symlink atomically, so the website being served is never half
+    written: requests see either the previous release or the new one.
+  - Each release records the hash of its files in SITE_MANIFEST. Files that haven't changed
+    since the previous release (and their precompressed versions) are hardlinked from it
+    instead of being copied again; only new or modified files are copied. Files that no
+    longer exist, e.g. the networks of deleted topics, are not part of the new release.
+  - Hashes are only computed again for files whose size or modification time changed,
+    and when nothing changed no release is made: such builds take milliseconds.
+  - With `hardlink`, new files are hardlinked from the topics and static folders too,
+    instead of being copied. This only works on a single file system, and files edited
+    in place (as some editors do) then change in the published website as well.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+from ..settings import *
+from .helpers import *
+from .compress import file_hash, precompress_website
+from .writers import export_extensions
+
+
+
+def site_files():
+    """
+    Returns the files of the website, as a dict of path in the website => source file.
+    The files of the export formats (e.g. GraphML) are not used by the viewer, and are left out.
+    """
+    files = {}
+    sources = [
+        (PROJECT_STATIC_PATH, "", {"index_template.html"}, ()),
+        (DEFAULT_TOPICS_SQL_PATH, "topics/", {os.path.basename(DEFAULT_BUILD_MANIFEST)}, export_extensions()),
+    ]
+    for root, prefix, ignored, ignored_extensions in sources:
+        for dirpath, dirnames, filenames in os.walk(root):
+            for f in filenames:
+                if f in ignored or f.endswith(".tmp") or f.endswith(ignored_extensions):
+                    continue
+                path = os.path.join(dirpath, f)
+                files[prefix + os.path.relpath(path, root)] = path
+    return files
+
+
+
+def current_release():
+    """Returns the folder of the website currently published, or None."""
+    if os.path.islink(DEFAULT_BUILD_PATH):
+        return os.path.realpath(DEFAULT_BUILD_PATH)
+    if os.path.isdir(DEFAULT_BUILD_PATH):
+        return DEFAULT_BUILD_PATH # built before releases were introduced
+    return None
+
+
+
+def _load_manifest(release):
+    try:
+        with open(f"{release}/{SITE_MANIFEST}", "r") as input:
+            return json.load(input)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+
+def publish_website(generated, hardlink=False):
+    """
+    Publishes the website made of the static files, the topics folder and the `generated`
+    files (a dict of path in the website => contents, e.g. the index page). See the module docstring.
+
+    Returns the folder of the published release.
+    """
+    current = current_release()
+    previous = _load_manifest(current)
+    sources = site_files()
+
+    # hash of each file, reused from the previous release when its source hasn't changed
+    manifest = {}
+    for relpath, source in sources.items():
+        stat = os.stat(source)
+        entry = previous.get(relpath)
+        if not entry or entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime_ns:
+            entry = {"hash": file_hash(source), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+        manifest[relpath] = entry
+    for relpath, contents in generated.items():
+        manifest[relpath] = {"hash": hashlib.sha256(contents.encode()).hexdigest()}
+
+    def unchanged(relpath):
+        return relpath in previous and previous[relpath]["hash"] == manifest[relpath]["hash"] and os.path.isfile(f"{current}/{relpath}")
+
+    if current and previous.keys() == manifest.keys() and all(unchanged(x) for x in manifest):
+        if manifest != previous:  # files touched but not modified: don't hash them again next time
+            with open(f"{current}/{SITE_MANIFEST}", "w") as output:
+                json.dump(manifest, output, indent=2, sort_keys=True)
+        printInfo(f"  Website unchanged: {os.path.relpath(current, PROJECT_ROOT)}", "comment")
+        return current
+
+    # stage the new release
+    release = f"{DEFAULT_BUILD_RELEASES_PATH}/{datetime.now():%Y%m%d-%H%M%S-%f}"
+    copied = linked = 0
+    for relpath in manifest:
+        path = f"{release}/{relpath}"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if unchanged(relpath):
+            os.link(f"{current}/{relpath}", path)
+            for extension in (".gz", ".br"):
+                if os.path.isfile(f"{current}/{relpath}{extension}"):
+                    os.link(f"{current}/{relpath}{extension}", path + extension)
+            linked += 1
+        elif relpath in generated:
+            with open(path, "w") as output:
+                output.write(generated[relpath])
+            copied += 1
+        else:
+            try:
+                if not hardlink:
+                    raise OSError
+                os.link(sources[relpath], path)
+            except OSError:
+                shutil.copy2(sources[relpath], path)
+            copied += 1
+    if current and os.path.isfile(f"{current}/{PRECOMPRESS_MANIFEST}"):
+        # a copy, as it gets updated: hardlinked files must not be modified
+        shutil.copy2(f"{current}/{PRECOMPRESS_MANIFEST}", f"{release}/{PRECOMPRESS_MANIFEST}")
+    printInfo(f"  Staged {copied} new or changed files ({linked} unchanged)", "comment")
+
+    # gzip/brotli versions of the network files and JS bundles
+    precompress_website(release)
+
+    with open(f"{release}/{SITE_MANIFEST}", "w") as output:
+        json.dump(manifest, output, indent=2, sort_keys=True)
+
+    # publish: swap the symlink
+    if current == DEFAULT_BUILD_PATH:
+        legacy = f"{DEFAULT_BUILD_RELEASES_PATH}/00000000-legacy"
+        shutil.rmtree(legacy, ignore_errors=True)
+        os.rename(DEFAULT_BUILD_PATH, legacy)
+    link = f"{DEFAULT_BUILD_PATH}.tmp"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.relpath(release, os.path.dirname(DEFAULT_BUILD_PATH)), link)
+    os.replace(link, DEFAULT_BUILD_PATH)
+    printInfo(f"  Published: {os.path.relpath(DEFAULT_BUILD_PATH, PROJECT_ROOT)} -> {os.path.relpath(release, PROJECT_ROOT)}", "comment")
+
+    # older releases may still be in use by requests started before the swap: keep a few
+    for old in sorted(os.listdir(DEFAULT_BUILD_RELEASES_PATH))[:-SITE_KEEP_RELEASES]:
+        shutil.rmtree(f"{DEFAULT_BUILD_RELEASES_PATH}/{old}", ignore_errors=True)
+
+    return release
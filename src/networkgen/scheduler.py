@@ -0,0 +1,118 @@
+"""
+Runs network generation jobs concurrently
+"""
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import time
+
+from ..settings import *
+from .helpers import *
+
+
+# A single unit of work: one network type, for one topic file
+NetworkJob = namedtuple("NetworkJob", ["sql_file", "task", "metadata"])
+
+# Several topics for the same network type, computed with a single query
+NetworkBatch = namedtuple("NetworkBatch", ["task", "jobs"])
+
+# The outcome of a job. `error` is None if it completed successfully.
+# `query_seconds` is the time taken by `run` in its worker thread, `render_seconds` that of `render`
+# (which includes downloading streamed results), not counting the time spent waiting in between.
+JobResult = namedtuple("JobResult", ["job", "query_seconds", "render_seconds", "error"])
+
+
+
+def run_jobs(jobs, run, render, max_workers=1):
+    """
+    Runs jobs in a bounded thread pool, and renders each result as soon as it arrives.
+
+    Query jobs spend most of their time waiting for BigQuery, so running
+    them in threads lets several of them execute at the same time. Rendering
+    happens in the calling thread, in the order in which jobs complete.
+
+    Inputs:
+      - jobs (list): NetworkJob or NetworkBatch tuples.
+      - run (function): Called with a job in a worker thread. Returns the network data.
+      - render (function): Called with a job and the data returned by `run`.
+      - max_workers (int): How many jobs can run at the same time.
+
+    Returns a list of JobResult tuples, one per job.
+    """
+    results = []
+    total = len(jobs)
+
+    def timed_run(job):
+        start = time.time()
+        try:
+            return run(job), time.time() - start, None
+        except Exception as e:
+            return None, time.time() - start, e
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(timed_run, job): job for job in jobs}
+        for n, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            data, query_seconds, error = future.result()
+            start = time.time()
+            if error is None:
+                try:
+                    render(job, data)
+                except Exception as e:
+                    error = e
+            render_seconds = time.time() - start
+            results.append(JobResult(job, query_seconds, render_seconds, error))
+            if error is None:
+                printInfo(f"[{n}/{total}] Done: {job_name(job)} (query {query_seconds:.1f}s, render {render_seconds:.1f}s)", "green")
+            else:
+                printInfo(f"[{n}/{total}] FAILED: {job_name(job)} ({error})", "red")
+
+    return results
+
+
+
+def job_name(job):
+    """Short description of a job, for log messages."""
+    if isinstance(job, NetworkBatch):
+        return f"batch of {len(job.jobs)} topics / {job.task}"
+    return f"{os.path.basename(job.sql_file)} / {job.task}"
+
+
+
+def make_batches(jobs, batch_size=None):
+    """
+    Groups jobs by network type into NetworkBatch tuples of at most `batch_size` jobs each (no limit if None).
+    """
+    batches = []
+    for task in NETWORK_TYPES:
+        task_jobs = [job for job in jobs if job.task == task]
+        size = batch_size or len(task_jobs) or 1
+        for i in range(0, len(task_jobs), size):
+            batches.append(NetworkBatch(task, task_jobs[i:i + size]))
+    return batches
+
+
+
+def print_jobs_summary(results):
+    """Prints a summary of the jobs run, listing failures if any."""
+    failed = [x for x in results if x.error is not None]
+    printInfo(f"Jobs completed: {len(results) - len(failed)}/{len(results)}", "important")
+    printInfo(f"  {'':6} {'query':>8} {'render':>8}", "comment")
+    for r in sorted(results, key=lambda x: x.query_seconds + x.render_seconds, reverse=True):
+        status = "FAILED" if r.error is not None else "ok"
+        printInfo(f"  {status:6} {r.query_seconds:7.1f}s {r.render_seconds:7.1f}s  {job_name(r.job)}", "red" if r.error is not None else "comment")
+    for r in failed:
+        printDebug(f"  {job_name(r.job)}: {r.error}", "red")
+
+
+
+def print_query_timings(timings):
+    """Prints the timings of the BigQuery jobs run (see bqdata.JobTiming)."""
+    if not timings:
+        return
+    printInfo(f"BigQuery jobs: {len(timings)}", "important")
+    printInfo(f"  {'queued':>8} {'running':>8} {'total':>8} {'billed':>10}", "comment")
+    for t in timings:
+        billed = format_bytes(t.bytes_billed or 0) if not t.cache_hit else "cached"
+        printInfo(f"  {t.queued or 0:7.1f}s {t.running or 0:7.1f}s {t.total:7.1f}s {billed:>10}  {t.label or t.job_id}", "comment")
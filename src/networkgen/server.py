@@ -1,14 +1,358 @@
+"""
+Local web server for the generated website (`--runserver`).
+
+Requests are handled in parallel threads, so a slow client downloading a large network
+doesn't hold up the others. Responses are cache friendly:
+  - ETag and Last-Modified headers, and `304 Not Modified` answers to conditional requests;
+  - precompressed files (see compress.py), or else gzip compression on the fly, depending
+    on the Accept-Encoding header of the request;
+  - byte Range requests;
+  - long-lived Cache-Control headers for files whose name contains a content hash.
+"""
+
+import email.utils
+import functools
+import gzip
+import hashlib
 import http.server
+import io
 import os
-import socketserver
+import re
+import json
+import threading
+import urllib.parse
+from collections import OrderedDict
 
 from ..settings import *
+from .helpers import *
+from .api import ApiError
+from .ego import EgoIndex
+from .compress import compressed_encodings
+
+
+
+class _GzipCache:
+    """Compressed responses, kept in memory up to `max_size` bytes (least recently used ones are dropped first)."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.pending = {}  # key => lock held while the file is compressed, shared by concurrent requests
+
+    def get(self, key, load):
+        """Returns the compressed version of the data returned by `load()`, cached under `key`."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            pending = self.pending.setdefault(key, threading.Lock())
+        with pending:
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+            data = gzip.compress(load(), SERVER_GZIP_LEVEL, mtime=0)
+            with self.lock:
+                self.entries[key] = data
+                self.size += len(data)
+                self.pending.pop(key, None)
+                while self.size > self.max_size and len(self.entries) > 1:
+                    self.size -= len(self.entries.popitem(last=False)[1])
+        return data
+
+
+
+class _FileRange:
+    """Read-only view of `length` bytes of an open file, from `start`."""
+
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+
+def accepted_encodings(header):
+    """Returns the set of content codings accepted by a client, given its Accept-Encoding header."""
+    accepted = set()
+    for item in header.split(","):
+        encoding, *params = [x.strip() for x in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if encoding and q > 0:
+            accepted.add(encoding.lower())
+    return accepted
+
+
+
+def byte_range(header, size):
+    """
+    Parses a Range header (a single `bytes=start-end` range) for a file of `size` bytes.
+    Returns (start, end) inclusive, "unsatisfiable", or None if the header is to be ignored
+    (invalid, or several ranges: the whole file is then sent).
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    start, end = match.groups()
+    if start == "":
+        # suffix range: the last `end` bytes
+        if int(end) == 0:
+            return "unsatisfiable"
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return "unsatisfiable" if start >= size else None
+    return start, end
+
+
+
+class CachingHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Serves static files with validators (ETag, Last-Modified), content negotiation and
+    byte ranges. Directories and missing files are handled as in SimpleHTTPRequestHandler.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep connections open between requests
+    disable_nagle_algorithm = True  # otherwise small responses on kept-alive connections wait for delayed ACKs
+    gzip_cache = _GzipCache(SERVER_GZIP_CACHE_SIZE)
+    immutable = re.compile(SERVER_IMMUTABLE_PATTERN)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split("?")[0].split("#")[0].endswith("/"):
+            path = os.path.join(path, "index.html")
+        if not os.path.isfile(path):
+            return super().send_head()
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            return self.send_file(f, path)
+        except Exception:
+            f.close()
+            raise
+
+
+    def send_file(self, f, path):
+        fs = os.fstat(f.fileno())
+        ctype = self.guess_type(path)
+        last_modified = self.date_time_string(fs.st_mtime)
+        etag = f'"{fs.st_mtime_ns:x}-{fs.st_size:x}'
+        compressible = any(ctype.startswith(x) for x in SERVER_GZIP_TYPES)
+
+        # choose a representation: ranges are only served from the uncompressed file
+        encoding, body, length = None, f, fs.st_size
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding", ""))
+        if "Range" not in self.headers:
+            for name, extension in compressed_encodings():
+                compressed = path + extension
+                if name in accepted and os.path.isfile(compressed) and os.path.getmtime(compressed) >= fs.st_mtime:
+                    body = open(compressed, "rb")
+                    f.close()
+                    encoding, length = name, os.fstat(body.fileno()).st_size
+                    break
+            else:
+                if "gzip" in accepted and compressible and fs.st_size >= SERVER_GZIP_MIN_SIZE:
+                    data = self.gzip_cache.get((path, etag), functools.partial(_read, path))
+                    f.close()
+                    encoding, body, length = "gzip", io.BytesIO(data), len(data)
+        etag += f'-{encoding}"' if encoding else '"'
+
+        if self.not_modified(etag, fs.st_mtime):
+            body.close()
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_validators(path, etag, last_modified, compressible)
+            self.end_headers()
+            return None
+
+        status, content_range = http.HTTPStatus.OK, None
+        if "Range" in self.headers and self.headers.get("If-Range", etag) in (etag, last_modified):
+            requested = byte_range(self.headers["Range"], fs.st_size)
+            if requested == "unsatisfiable":
+                body.close()
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{fs.st_size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return None
+            if requested:
+                start, end = requested
+                status, content_range = http.HTTPStatus.PARTIAL_CONTENT, f"bytes {start}-{end}/{fs.st_size}"
+                body, length = _FileRange(body, start, end - start + 1), end - start + 1
+
+        self.send_response(status)
+        self.send_header("Content-type", ctype)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_validators(path, etag, last_modified, compressible)
+        self.end_headers()
+        return body
+
+
+    def send_validators(self, path, etag, last_modified, compressible):
+        """Sends the headers shared by full, partial and `304 Not Modified` responses."""
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if self.immutable.search(os.path.basename(path)):
+            self.send_header("Cache-Control", f"public, max-age={SERVER_IMMUTABLE_MAX_AGE}, immutable")
+        else:
+            # cached copies can be used once revalidated with the ETag
+            self.send_header("Cache-Control", "no-cache")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+
+
+    def not_modified(self, etag, mtime):
+        """Returns True if the client's cached copy is current (If-None-Match, or else If-Modified-Since)."""
+        if "If-None-Match" in self.headers:
+            tags = [re.sub(r"^W/", "", x.strip()) for x in self.headers["If-None-Match"].split(",")]
+            return "*" in tags or etag in tags
+        if "If-Modified-Since" in self.headers and mtime is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+
+
+
+class ApiHandler(CachingHandler):
+    """
+    Also answers API requests:
+      - `/api/network`: networks generated on demand, with a NetworkService (see api.py);
+      - `/api/ego`: neighbourhoods of nodes of the built networks, with an EgoIndex (see ego.py);
+      - `/api/build`: time of the last build, so that pages can reload when it changes (see --watch).
+    Responses are compressed and support ETags, like files.
+    """
+
+    def __init__(self, *args, service=None, index=None, **kwargs):
+        self.service = service
+        self.index = index
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        endpoints = {
+            "/api/network": self.service.network if self.service else None,
+            "/api/ego": self.index.ego if self.index else None,
+            "/api/build": self.build_status,
+        }
+        if url.path in endpoints:
+            self.send_api(endpoints[url.path], dict(urllib.parse.parse_qsl(url.query)))
+        else:
+            super().do_GET()
+
+
+    def build_status(self, params):
+        """
+        Returns an identifier of the last build of the website (see livereload.js): the release
+        published (see publish.py), and the time of its index page for folders built otherwise.
+        """
+        release = os.path.realpath(self.directory)
+        try:
+            built = f"{os.path.basename(release)}/{os.stat(os.path.join(release, 'index.html')).st_mtime_ns}"
+        except FileNotFoundError:
+            built = None
+        return "build", json.dumps({"built": built}).encode()
+
+
+    def send_api(self, endpoint, params):
+        """Sends the JSON returned by an endpoint, as a tuple (key, JSON bytes), or the error it raised."""
+        if endpoint is None:
+            return self.send_api_error(http.HTTPStatus.NOT_FOUND, "Not available: see the --api option")
+        try:
+            key, body = endpoint(params)
+        except ApiError as e:
+            return self.send_api_error(e.status, str(e))
+        except Exception as e:
+            printDebug(f"API error: {self.path}: {e}", "red")
+            return self.send_api_error(http.HTTPStatus.BAD_GATEWAY, f"Failed to generate the network: {e}")
+
+        # cached networks are regenerated once stale, with possibly different results: tag their contents
+        etag = f'"{hashlib.sha1(body).hexdigest()}'
+        if "gzip" in accepted_encodings(self.headers.get("Accept-Encoding", "")) and len(body) >= SERVER_GZIP_MIN_SIZE:
+            body, encoding = self.gzip_cache.get(("api", etag), lambda: body), "gzip"
+            etag += '-gzip"'
+        else:
+            encoding = None
+            etag += '"'
+
+        if self.not_modified(etag, None):
+            self.send_response(http.HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(http.HTTPStatus.OK)
+        self.send_header("Content-type", "application/json")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_api_error(self, status, message):
+        body = json.dumps({"error": message}).encode()
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if status == http.HTTPStatus.SERVICE_UNAVAILABLE:
+            self.send_header("Retry-After", "10")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+def make_server(port, directory=DEFAULT_BUILD_PATH, host="", handler=CachingHandler):
+    """Returns a multi-threaded HTTP server serving `directory` (the working directory is left unchanged)."""
+    handler = functools.partial(handler, directory=directory)
+    return http.server.ThreadingHTTPServer((host, port), handler)
+
 
-def go(port):
-    web_dir = DEFAULT_BUILD_PATH
-    os.chdir(web_dir)
-    Handler = http.server.SimpleHTTPRequestHandler
 
-    with socketserver.TCPServer(("", port), Handler) as httpd:
+def go(port, directory=DEFAULT_BUILD_PATH, service=None):
+    """
+    Serves the website on `port`, and the neighbourhoods of the nodes of its networks under
+    `/api/ego`. With a NetworkService (see api.py), also generates networks on demand, under `/api/network`.
+    """
+    index = EgoIndex(directory)
+    threading.Thread(target=index.load_all, daemon=True).start()
+    handler = functools.partial(ApiHandler, service=service, index=index)
+    with make_server(port, directory, handler=handler) as httpd:
         print(f"\n\n-------\nServing at http://127.0.0.1:{port} ...")
         httpd.serve_forever()
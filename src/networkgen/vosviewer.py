@@ -1,139 +1,386 @@
+import glob
 import json
+import os
 import urllib
 import shutil 
+from array import array
+from itertools import chain, islice
 
 from ..settings import *
 from .helpers import *
+from .network import Network, node_search, link_search_parts
+from .writers import WRITERS, writer, output_path, remove_outputs
+from .prune import prune_network, detail_levels, strongest_links
+from .layout import network_layout
+from .clustering import network_clusters
 
 
 
 
-def render_json(data, task, node_label, link_label, sql_file):
+def network_json_path(sql_file, task, level=None):
     """
-    Shared function that accepts pairwise data returned from BigQuery and
-    converts it into a VOSviewer JSON file.
+    Returns the path of the JSON file for a topic SQL file and network type.
+    With `level`, returns the path of the level of detail with that many links, e.g. `topic.links-1000.json`.
+    """
+    return output_path(sql_file, task, '.json' if level is None else f'.links-{level}.json')
+
+
+
+def levels_json_path(sql_file, task):
+    """
+    Returns the path of the file listing the levels of detail of a network, e.g. `topic.levels.json`.
+    """
+    return network_json_path(sql_file, task).replace('.json', '.levels.json')
+
+
+
+def render_network(data, task, sql_file, config, layout=False, clustering=False, formats=("vosviewer",), **render_options):
+    """
+    Builds a Network from query results, prunes it according to its parameters, and writes it
+    in each of the output `formats` (see writers.py).
+
+    The query results are read only once: all formats are written from the same Network.
+
+    With `layout`, the coordinates of the nodes are computed here (see layout.py), once for the
+    full network: its levels of detail use the same coordinates, so that nodes don't move when
+    switching between them. The same goes for the clusters of the nodes, with `clustering` (see clustering.py).
+
+    When none of these needs the whole network (VOSviewer format only, no pruning, no levels of
+    detail, no layout nor clusters), the file is written while reading the query results instead,
+    keeping only a table of the nodes in memory (see stream_json). The same goes for networks with
+    more than STREAM_MIN_LINKS links, whose layout and clusters are then left to the viewer: only
+    that many rows are read before choosing.
+
+    Inputs:
+        - data (iterable): (node1, node2, weight) rows, as returned by gen_network.
+        - config (dict): The network parameters, see extract_query_metadata.
+        - formats (list): Names of the output formats, see WRITERS.
+        - render_options: Passed to the writers (eg `compact_links`).
+
+    Returns a tuple (number of nodes, number of edges, list of files written) for the full network.
+    """
+    remove_outputs(sql_file, task, formats)
+
+    if list(formats) == ["vosviewer"] and not needs_network(config):
+        streaming = not layout and not clustering
+        if not streaming:
+            # read up to STREAM_MIN_LINKS rows before choosing
+            data = iter(data)
+            first = list(islice(data, STREAM_MIN_LINKS + 1))
+            data = chain(first, data)
+            streaming = len(first) > STREAM_MIN_LINKS
+            if streaming:
+                printDebug(f"  More than {STREAM_MIN_LINKS} links: streaming the network, layout and clusters are left to the viewer.", "comment")
+        if streaming:
+            node_label, link_label = NETWORK_LABELS[task]
+            remove_levels(sql_file, task)
+            nodes, edges = stream_json(data, task, node_label, link_label, sql_file, **render_options)
+            return nodes, edges, [network_json_path(sql_file, task)] if nodes else []
+
+    network = build_network(data, task, config, layout, clustering)
+
+    files = []
+    for name in formats:
+        files += WRITERS[name](network, sql_file, config, **render_options)
+
+    return network.n_nodes, network.n_links, files
+
+
+
+def needs_network(config):
+    """Returns True if the parameters of a network require all its links before writing it (pruning, levels of detail)."""
+    return str(config.get('prune', 'none')).strip() != 'none' or bool(detail_levels(config))
+
+
+
+def remove_levels(sql_file, task):
+    """Removes the levels of detail of a previous build of a network."""
+    for f in glob.glob(glob.escape(network_json_path(sql_file, task)).replace('.json', '.links-*.json')) + [levels_json_path(sql_file, task)]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+
+def build_network(data, task, config, layout=False, clustering=False):
+    """
+    Returns the Network of query results, pruned according to its parameters, with the
+    coordinates (`layout`) and clusters (`clustering`) of its nodes if requested.
+    """
+    network = prune_network(Network.from_rows(task, data), config)
+    if network.n_nodes:
+        if layout:
+            network.coordinates = network_layout(network)
+        if clustering:
+            network.clusters = network_clusters(network)
+    return network
+
+
+
+@writer("vosviewer")
+def write_vosviewer(network, sql_file, config, **render_options):
+    """
+    Writes a network to a VOSviewer JSON file (see render_json), together with its levels of detail.
+
+    Each level of detail contains the strongest links of the network, e.g. 1000 or 5000
+    links, and is written only if the network has more links than that. The available files
+    are listed in `topic.levels.json`, from the smallest to the full network, so that the
+    viewer can load a small file first and fetch the larger ones on demand.
+    """
+    task = network.task
+    node_label, link_label = NETWORK_LABELS[task]
+
+    remove_levels(sql_file, task)
+
+    nodes, edges = render_json(network, node_label, link_label, sql_file, **render_options)
+    if not nodes:
+        return []
+    files = [network_json_path(sql_file, task)]
+
+    index = []
+    for level in detail_levels(config):
+        if level < edges:
+            printDebug(f"  Level of detail: {level} links", "comment")
+            n_nodes, n_edges = render_json(
+                network.subset(strongest_links(network.weight, level)),
+                node_label, link_label, sql_file, level=level, **render_options
+            )
+            index.append({"links": n_edges, "nodes": n_nodes, "json": os.path.basename(network_json_path(sql_file, task, level))})
+            files.append(network_json_path(sql_file, task, level))
+
+    if index:
+        index.append({"links": edges, "nodes": nodes, "json": os.path.basename(network_json_path(sql_file, task))})
+        with open(levels_json_path(sql_file, task), "w") as output:
+            json.dump({"levels": index}, output, indent=2)
+        files.append(levels_json_path(sql_file, task))
+
+    return files
+
+
+
+def render_json(network, node_label, link_label, sql_file, compact_links=False, integer_ids=False, level=None, path=None):
+    """
+    Shared function that writes a Network into a VOSviewer JSON file.
 
     Inputs:
-        - data (iterable): Results returned by GBQ. Each row is expected
-            to include 5 elements: node1_id, node1_name, node2_id, node2_name,
-            and a final integer indicating the strength of the link between
-            node1 and node2.
+        - network (Network): The nodes and links, see network.py. Its coordinates and clusters are
+            written too when available: the viewer then doesn't compute them itself.
         - node_label (string): What does a single node represent? Ex. "Organization"
         - link_label (string): What does a single link represent? Ex. "Publication"
         - sql_file (string): Path to SQL file
+        - compact_links (bool): Don't store the URL of each link: the viewer builds it from the
+            `link_description` template and the search fragments of the two nodes. This avoids
+            repeating the (long) base Dimensions URL in every link, making files several times smaller.
+        - integer_ids (bool): Identify nodes with dense integer IDs (0, 1, 2...) instead of their
+            labels, so that each label is stored only once, in the items list.
+        - level (int): Write the file of this level of detail (see render_network), instead of the full network.
+        - path (string): Write to this file instead of the topic's JSON file (e.g. for networks generated on demand, see api.py).
+
+    Returns a tuple (number of nodes, number of edges). The file is not written if there are no nodes.
+
+    Links are written first, straight from the network arrays, then the items (the order of keys in a
+    JSON object doesn't matter to VOSviewer). The per-node strings (labels, search fragments) are
+    escaped only once, and links are serialized by hand from them, which is much faster than with json.dumps.
 
     About hyperlinks:
     For some reason the edges URLs can be added to the JSON directly via the `url` key, however that does not work with nodes.
     Hence with nodes we have to use a config/template structure, and pass a variable `custom_search` into the JSON which is then resolved in the front end JS layer. 
+    With `compact_links`, the same is done with the edges, but the viewer keeps no custom attributes of links (only `url`
+    and `description`): their template refers to attributes of their nodes instead, `{source_search_left}{target_search_right}`
+    (see Network.link_search_parts). The viewer orders the two nodes of a link by ID, which may swap them: the search is the same.
 
     TODO: clarify with https://app.vosviewer.com/docs/ folks 
     """
 
-    edges = [] # links between two-concept combinations
-    labels = {}
-    OUTFILE_NAME = sql_file.split("/")[-1].replace(' ', '_').replace('.sql', '.json')
-    OUTFILE_NAME = f"{DEFAULT_TOPICS_JSON_PATH}/{task}/{OUTFILE_NAME}"
+    OUTFILE_NAME = path or network_json_path(sql_file, network.task, level)
+    TMPFILE_NAME = f"{OUTFILE_NAME}.tmp"
 
-    try:
-        for row in data:
-            node1_id, node2_id, collabs = row
-            edges.append((node1_id, node2_id, int(collabs)))
-            labels[node1_id] = node1_id
-            labels[node2_id] = node2_id
-    except Exception:
-        printDebug('  Error collating data for network.')
-        raise
+    config = _vosviewer_config(node_label, link_label, compact_links)
 
-    # Data to be written
-    towrite = {
-        "config":{
-            "terminology":{
-                "item": node_label,
-                "items": f"{node_label}s",
-                "link": link_label,
-                "links": f"{link_label}s",
-                "link_strength": f"{link_label} links",
-                "total_link_strength": "Total links"
-            },
-            "templates":{
-                # DIMENSIONS LINKS: NODES
-                "item_description":"<div class='description_heading'>"+node_label+"</div><div class='description_label'><a class='description_url' href='"+BASE_DIMENSIONS_URL+"' target='_blank'>{label}</a></div>",
-                # DIMENSIONS LINKS: EDGES
-                "link_description":"<div class='description_heading'>"+link_label+"</div><div class='description_label'>{source_label} + {target_label}</div>"
-            },
-            "styles":{
-                "description_heading":"color: #757575; font-weight: 600;"
-            }
-        },
-        "network":{
-            "items":[],
-            "links":[]
-        }
-    }
+    if not network.n_nodes:
+        printDebug(f"  => Nodes: 0. Edges: 0.", "important")
+        printDebug(f'  No nodes found - maybe review your query?', "red")
+        return 0, 0
 
-    # build network
-    nodes = []
+    # JSON values used in links, by node ID: quoted label or integer ID
+    ids = [str(i) for i in range(network.n_nodes)] if integer_ids else [json.dumps(x) for x in network.labels]
+    # link URLs, by node ID: url = left[source] + right[target], in the links or through the template of the viewer
+    search_left, search_right = network.link_search_parts()
+    if compact_links:
+        left = right = [""] * network.n_nodes
+    else:
+        url_start, url_end = (_json_escape(x) for x in BASE_DIMENSIONS_URL.split("{custom_search}"))
+        left = [', "url": "' + url_start + _json_escape(x) for x in search_left]
+        right = [_json_escape(x) + url_end + '"' for x in search_right]
 
-    # EDGES
+    with open(TMPFILE_NAME, "w") as outfile:
 
-    try:
-        for edge in edges:
-            nodes.append(edge[0])
-            nodes.append(edge[1])
-            url_safe = "http://www.app.dimensions.ai"
-            
-            if task == "concepts":
-                url_safe = "%20AND%20%22" + edge[0].replace(" ", "%20") + "%20AND%20" + edge[1].replace(" ", "%20") + "%22"
-            
-            elif task == "organizations":
-                grid_id1 = edge[0][edge[0].index("grid"):-1]
-                grid_id2 = edge[1][edge[1].index("grid"):-1]
-                # url_safe = urllib.parse.quote(f' "{edge[0]}" AND "{edge[1]}" ')
-                url_safe = f"&and_facet_research_org={grid_id1}&and_facet_research_org={grid_id2}"
-            
-            towrite['network']['links'].append({
-                'source_id': edge[0],
-                'target_id': edge[1],
-                'url': BASE_DIMENSIONS_URL.format(custom_search=url_safe), 
-                'strength': edge[2]
-            })
-        nodes = list(set(nodes))
-    except Exception:
-        printDebug('Error when building list of nodes and edges.')
-        raise
+        outfile.write('{"config": ' + json.dumps(config) + ', "network": {"links": [')
 
-    # NODES
+        # EDGES
 
-    for node in nodes:
-        if task == "concepts":
-            extra_string = "%20AND%20%22" + node.replace(" ", "%20") + "%22"
+        for n, (i, j, strength) in enumerate(zip(network.source.tolist(), network.target.tolist(), network.weight.tolist())):
+            outfile.write(
+                f'{", " if n else ""}{{"source_id": {ids[i]}, "target_id": {ids[j]}{left[i]}{right[j]}, "strength": {strength}}}'
+            )
 
-        elif task == "organizations":    
-            # org nodes are formatted as "King's College London (grid.13097.3c)"
-            grid_id = node[node.index("grid"):-1]
-            extra_string = f"&and_facet_research_org={grid_id}"
+        # NODES
 
-        towrite['network']['items'].append({
-            'id': node,
-            'custom_search': extra_string, # e.g.%22Health%20Organization%22
-            'label': labels[node],
-        })
+        outfile.write('], "items": [')
+        degrees, strengths = network.degrees().tolist(), network.strengths().tolist()
+        for i, node in enumerate(network.labels):
+            item = _json_item(i, node, network.search[i], degrees[i], strengths[i], integer_ids, compact_links, (search_left[i], search_right[i]))
+            if network.coordinates is not None:
+                item['x'], item['y'] = network.coordinates[i].tolist()
+            if network.clusters is not None:
+                item['cluster'] = int(network.clusters[i])
+            outfile.write((", " if i else "") + json.dumps(item))
+        outfile.write(']}}')
 
     # Finally, save the JSON file
 
-    printDebug(f"  => Nodes: {len(towrite['network']['items'])}. Edges: {len(towrite['network']['links'])}.", "important")
-    if len(towrite['network']['items']):
-        printDebug(f'Writing network information to file:', "comment")
-        printDebug(f'  ... {OUTFILE_NAME}', "comment")
-        with open(OUTFILE_NAME, "w") as outfile:
-            json.dump(towrite, outfile)
+    printDebug(f"  => Nodes: {network.n_nodes}. Edges: {network.n_links}.", "important")
+    printDebug(f'Writing network information to file:', "comment")
+    printDebug(f'  ... {OUTFILE_NAME}', "comment")
+    os.replace(TMPFILE_NAME, OUTFILE_NAME)
 
-    else:
+    printDebug('  Process complete.', "comment")
+
+    return network.n_nodes, network.n_links
+
+
+
+def stream_json(data, task, node_label, link_label, sql_file, compact_links=False, integer_ids=False, path=None):
+    """
+    Writes query results into a VOSviewer JSON file while reading them, without building a Network:
+    only the table of nodes is kept in memory, not the links. The file is the same as with render_json
+    for a network without pruning, levels of detail, coordinates nor clusters (see render_network).
+
+    Links can't be merged here: each pair of nodes is expected only once, as returned by the
+    network queries (see canonical_edges). Rows listing a pair twice are written as two links.
+
+    Inputs and return value: see render_json.
+    """
+
+    OUTFILE_NAME = path or network_json_path(sql_file, task)
+    TMPFILE_NAME = f"{OUTFILE_NAME}.tmp"
+
+    config = _vosviewer_config(node_label, link_label, compact_links)
+
+    # by node ID, as in render_json, extended as nodes are found
+    nodes, labels, search, ids, left, right = {}, [], [], [], [], []
+    degrees, strengths = array('q'), array('q')
+    if not compact_links:
+        url_start, url_end = (_json_escape(x) for x in BASE_DIMENSIONS_URL.split("{custom_search}"))
+
+    edges = 0
+    try:
+        with open(TMPFILE_NAME, "w") as outfile:
+
+            outfile.write('{"config": ' + json.dumps(config) + ', "network": {"links": [')
+
+            # EDGES
+
+            for node1, node2, strength in canonical_edges(data, nodes):
+                # new nodes get the next IDs, in this order (see canonical_edges)
+                for node in (node1, node2):
+                    if nodes[node] == len(labels):
+                        labels.append(node)
+                        search.append(node_search(task, node))
+                        ids.append(str(len(ids)) if integer_ids else json.dumps(node))
+                        if compact_links:
+                            left.append("")
+                            right.append("")
+                        else:
+                            search_left, search_right = link_search_parts(task, search[-1])
+                            left.append(', "url": "' + url_start + _json_escape(search_left))
+                            right.append(_json_escape(search_right) + url_end + '"')
+                        degrees.append(0)
+                        strengths.append(0)
+                i, j = nodes[node1], nodes[node2]
+                outfile.write(
+                    f'{", " if edges else ""}{{"source_id": {ids[i]}, "target_id": {ids[j]}{left[i]}{right[j]}, "strength": {strength}}}'
+                )
+                for k in (i, j):
+                    degrees[k] += 1
+                    strengths[k] += strength
+                edges += 1
+
+            # NODES
+
+            outfile.write('], "items": [')
+            for i, node in enumerate(labels):
+                parts = link_search_parts(task, search[i]) if compact_links else None
+                item = _json_item(i, node, search[i], degrees[i], strengths[i], integer_ids, compact_links, parts)
+                outfile.write((", " if i else "") + json.dumps(item))
+            outfile.write(']}}')
+    except BaseException:
+        os.remove(TMPFILE_NAME)
+        raise
+
+    if not labels:
+        os.remove(TMPFILE_NAME)
+        printDebug(f"  => Nodes: 0. Edges: 0.", "important")
         printDebug(f'  No nodes found - maybe review your query?', "red")
+        return 0, 0
+
+    # Finally, save the JSON file
 
+    printDebug(f"  => Nodes: {len(labels)}. Edges: {edges}.", "important")
+    printDebug(f'Writing network information to file:', "comment")
+    printDebug(f'  ... {OUTFILE_NAME}', "comment")
+    os.replace(TMPFILE_NAME, OUTFILE_NAME)
 
     printDebug('  Process complete.', "comment")
 
+    return len(labels), edges
+
+
+
+def _vosviewer_config(node_label, link_label, compact_links=False):
+    """Returns the `config` section of a VOSviewer JSON file: terminology, and templates of the node and link descriptions."""
+    config = {
+        "terminology":{
+            "item": node_label,
+            "items": f"{node_label}s",
+            "link": link_label,
+            "links": f"{link_label}s",
+            "link_strength": f"{link_label} links",
+            "total_link_strength": "Total links"
+        },
+        "templates":{
+            # DIMENSIONS LINKS: NODES
+            "item_description":"<div class='description_heading'>"+node_label+"</div><div class='description_label'><a class='description_url' href='"+BASE_DIMENSIONS_URL+"' target='_blank'>{label}</a></div>",
+            # DIMENSIONS LINKS: EDGES
+            "link_description":"<div class='description_heading'>"+link_label+"</div><div class='description_label'>{source_label} + {target_label}</div>"
+        },
+        "styles":{
+            "description_heading":"color: #757575; font-weight: 600;"
+        }
+    }
+
+    if compact_links:
+        link_url = BASE_DIMENSIONS_URL.replace("{custom_search}", "{source_search_left}{target_search_right}")
+        config["templates"]["link_description"] = "<div class='description_heading'>"+link_label+"</div><div class='description_label'><a class='description_url' href='"+link_url+"' target='_blank'>{source_label} + {target_label}</a></div>"
+
+
+    return config
+
+
+
+def _json_item(i, node, search, degree, strength, integer_ids=False, compact_links=False, parts=None):
+    """Returns the JSON of a node in the `items` of a VOSviewer JSON file, without its coordinates and cluster."""
+    item = {
+        'id': i if integer_ids else node,
+        'custom_search': search, # e.g.%22Health%20Organization%22
+        'label': node,
+        'weights': {'Links': degree, 'Total link strength': strength},
+    }
+    if compact_links:
+        item['search_left'], item['search_right'] = parts
+    return item
 
 
 
+def _json_escape(text):
+    """Returns a string escaped for use within a JSON string (without the surrounding quotes)."""
+    return json.dumps(text)[1:-1]
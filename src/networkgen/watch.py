@@ -0,0 +1,112 @@
+"""
+Watches the topic SQL files (`--watch`), so that their networks are regenerated as soon
+as they are saved.
+
+Changes are detected with inotify (or its equivalent on other systems) through the
+`watchdog` package when it is installed, and otherwise by polling the folder every
+WATCH_POLL_INTERVAL seconds. Changes are debounced: editors often save a file in several
+steps, and several files can change at once (e.g. `git checkout`), so they are reported
+only once no file has changed for WATCH_DEBOUNCE seconds.
+"""
+
+import os
+import threading
+import time
+
+from ..settings import *
+from .helpers import *
+
+try:
+    # optional: file system notifications, instead of polling
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+
+def topic_files(path, only=None):
+    """Returns the SQL files of a folder (or `only` this one), as a dict of file path => (modification time, size)."""
+    files = {}
+    for f in os.listdir(path):
+        if f.endswith(".sql") and (only is None or os.path.join(path, f) == only):
+            try:
+                stat = os.stat(os.path.join(path, f))
+            except FileNotFoundError:
+                continue  # deleted in the meantime
+            files[os.path.join(path, f)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+
+def _start_observer(path, event):
+    """Starts a watchdog observer setting `event` when a SQL file changes, or returns None without watchdog."""
+    if Observer is None:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, e):
+            if str(e.src_path).endswith(".sql") or str(getattr(e, "dest_path", "")).endswith(".sql"):
+                event.set()
+
+    observer = Observer()
+    observer.schedule(Handler(), path, recursive=False)
+    observer.daemon = True
+    observer.start()
+    return observer
+
+
+
+def watch_topics(callback, path=DEFAULT_TOPICS_SQL_PATH, debounce=WATCH_DEBOUNCE, poll_interval=WATCH_POLL_INTERVAL):
+    """
+    Calls `callback(changed, deleted)` with the lists of SQL files created or modified, and
+    deleted, each time the topic files of `path` change. Runs until interrupted (Ctrl-C).
+    `path` is a folder, or a single SQL file (its folder is watched, for that file only).
+
+    Errors raised by `callback` are reported, and don't stop watching.
+    """
+    only = None
+    if not os.path.isdir(path):
+        folder = os.path.dirname(path) or "."
+        only, path = os.path.join(folder, os.path.basename(path)), folder
+    event = threading.Event()
+    observer = _start_observer(path, event)
+    if observer is None:
+        printInfo(f"Watching {only or path} for changes, every {poll_interval}s (install `watchdog` to be notified of changes instead)...", "comment")
+    else:
+        printInfo(f"Watching {only or path} for changes...", "comment")
+
+    state = topic_files(path, only)
+    try:
+        while True:
+            event.wait(poll_interval)
+            event.clear()
+            current = topic_files(path, only)
+            if current == state:
+                continue
+            # wait for the files to stop changing
+            while True:
+                time.sleep(debounce)
+                event.clear()
+                latest = topic_files(path, only)
+                if latest == current:
+                    break
+                current = latest
+
+            changed = sorted(f for f in current if state.get(f) != current[f])
+            deleted = sorted(f for f in state if f not in current)
+            state = current
+            for f in changed:
+                printInfo(f"Changed: {f}", "important")
+            for f in deleted:
+                printInfo(f"Deleted: {f}", "important")
+            try:
+                callback(changed, deleted)
+            except Exception as e:
+                printDebug(f"Failed to rebuild: {e}", "red")
+            printInfo(f"Watching {only or path} for changes...", "comment")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
@@ -0,0 +1,202 @@
+"""
+Output formats: each writer saves a Network (see network.py) to one or more files.
+
+Writers are registered by name with the `writer` decorator, and selected with the
+`--format` option. All formats are written from the same Network, built in a single
+pass over the query results. Files are written next to the VOSviewer JSON files,
+e.g. `topics/json/concepts/topic.graphml`.
+
+Writers are called as `write(network, sql_file, config, **options)` and return the
+list of paths written (nothing is written for networks without nodes).
+
+Only the VOSviewer files are part of the website (see publish.py): the files of the
+other formats, listed by extension with the `writer` decorator, stay in the topics folder.
+"""
+
+import csv
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+import pyarrow
+import pyarrow.parquet as pq
+
+from ..settings import *
+from .helpers import *
+
+
+
+WRITERS = {}
+EXPORT_EXTENSIONS = {}  # format => extensions of its files, for the formats not part of the website
+
+
+def writer(name, extensions=None):
+    """Decorator registering a writer function for an output format, with the `extensions` of its files if not part of the website."""
+    def register(function):
+        WRITERS[name] = function
+        if extensions:
+            EXPORT_EXTENSIONS[name] = extensions
+        return function
+    return register
+
+
+
+def export_extensions():
+    """Returns the extensions of the files of all export formats (see `writer`)."""
+    return tuple(x for extensions in EXPORT_EXTENSIONS.values() for x in extensions)
+
+
+
+def remove_outputs(sql_file, task, formats):
+    """Removes the files of a network left by a previous build in the export formats other than `formats`."""
+    for name, extensions in EXPORT_EXTENSIONS.items():
+        if name not in formats:
+            for extension in extensions:
+                path = output_path(sql_file, task, extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+
+def output_path(sql_file, task, extension):
+    """
+    Returns the path of an output file for a topic SQL file and network type, e.g. `.graphml`.
+    """
+    OUTFILE_NAME = sql_file.split("/")[-1].replace(' ', '_').replace('.sql', extension)
+    return f"{DEFAULT_TOPICS_JSON_PATH}/{task}/{OUTFILE_NAME}"
+
+
+
+class _AtomicFile:
+    """A file written under a temporary name, and moved into place once complete."""
+
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+
+    def __enter__(self):
+        self.file = open(f"{self.path}.tmp", "w", **self.kwargs)
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            os.replace(f"{self.path}.tmp", self.path)
+        else:
+            os.remove(f"{self.path}.tmp")
+
+
+
+def _node_columns(network):
+    """Returns the attributes of the nodes, as a dict of column name => list of values."""
+    columns = {
+        "id": list(range(network.n_nodes)),
+        "label": network.labels,
+        "links": network.degrees().tolist(),
+        "total_link_strength": network.strengths().tolist(),
+    }
+    if network.clusters is not None:
+        columns["cluster"] = network.clusters.tolist()
+    if network.coordinates is not None:
+        columns["x"] = network.coordinates[:, 0].tolist()
+        columns["y"] = network.coordinates[:, 1].tolist()
+    columns["custom_search"] = network.search
+    return columns
+
+
+
+@writer("graphml", [".graphml"])
+def write_graphml(network, sql_file, config=None, **options):
+    """Writes a network in GraphML format, e.g. for Gephi, Cytoscape or networkx."""
+    if not network.n_nodes:
+        return []
+    path = output_path(sql_file, network.task, ".graphml")
+    columns = _node_columns(network)
+    types = {"id": None, "label": "string", "links": "int", "total_link_strength": "int", "cluster": "int", "x": "double", "y": "double", "custom_search": "string"}
+
+    with _AtomicFile(path, encoding="utf-8") as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+        for name in columns:
+            if types[name]:
+                output.write(f'  <key id="{name}" for="node" attr.name="{name}" attr.type="{types[name]}"/>\n')
+        output.write('  <key id="weight" for="edge" attr.name="weight" attr.type="int"/>\n')
+        output.write('  <graph id="G" edgedefault="undirected">\n')
+        names = [name for name in columns if types[name]]
+        for i, values in enumerate(zip(*[columns[name] for name in names])):
+            data = "".join(f'<data key="{name}">{escape(str(value))}</data>' for name, value in zip(names, values))
+            output.write(f'    <node id="n{i}">{data}</node>\n')
+        for s, t, w in zip(network.source.tolist(), network.target.tolist(), network.weight.tolist()):
+            output.write(f'    <edge source="n{s}" target="n{t}"><data key="weight">{w}</data></edge>\n')
+        output.write('  </graph>\n</graphml>\n')
+
+    return [path]
+
+
+
+@writer("gexf", [".gexf"])
+def write_gexf(network, sql_file, config=None, **options):
+    """Writes a network in GEXF format, for Gephi. Coordinates, when available, are stored as positions."""
+    if not network.n_nodes:
+        return []
+    path = output_path(sql_file, network.task, ".gexf")
+    columns = _node_columns(network)
+    attributes = [(name, "integer" if name in ("links", "total_link_strength", "cluster") else "string")
+                  for name in columns if name not in ("id", "label", "x", "y")]
+
+    with _AtomicFile(path, encoding="utf-8") as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<gexf xmlns="http://www.gexf.net/1.2draft" xmlns:viz="http://www.gexf.net/1.2draft/viz" version="1.2">\n')
+        output.write('  <graph mode="static" defaultedgetype="undirected">\n    <attributes class="node">\n')
+        for n, (name, type) in enumerate(attributes):
+            output.write(f'      <attribute id="{n}" title="{name}" type="{type}"/>\n')
+        output.write('    </attributes>\n    <nodes>\n')
+        for i in range(network.n_nodes):
+            values = "".join(f'<attvalue for="{n}" value={quoteattr(str(columns[name][i]))}/>' for n, (name, _) in enumerate(attributes))
+            position = f'<viz:position x="{columns["x"][i]}" y="{columns["y"][i]}" z="0.0"/>' if "x" in columns else ""
+            output.write(f'      <node id="{i}" label={quoteattr(network.labels[i])}><attvalues>{values}</attvalues>{position}</node>\n')
+        output.write('    </nodes>\n    <edges>\n')
+        for n, (s, t, w) in enumerate(zip(network.source.tolist(), network.target.tolist(), network.weight.tolist())):
+            output.write(f'      <edge id="{n}" source="{s}" target="{t}" weight="{w}"/>\n')
+        output.write('    </edges>\n  </graph>\n</gexf>\n')
+
+    return [path]
+
+
+
+@writer("csv", [".nodes.csv", ".edges.csv"])
+def write_csv(network, sql_file, config=None, **options):
+    """Writes a network as two CSV files: a list of nodes (`topic.nodes.csv`) and a list of links (`topic.edges.csv`)."""
+    if not network.n_nodes:
+        return []
+    nodes_path = output_path(sql_file, network.task, ".nodes.csv")
+    edges_path = output_path(sql_file, network.task, ".edges.csv")
+    columns = _node_columns(network)
+
+    with _AtomicFile(nodes_path, encoding="utf-8", newline="") as output:
+        out = csv.writer(output)
+        out.writerow(columns)
+        out.writerows(zip(*columns.values()))
+
+    with _AtomicFile(edges_path, encoding="utf-8", newline="") as output:
+        out = csv.writer(output)
+        out.writerow(["source", "target", "weight"])
+        out.writerows(zip(network.source.tolist(), network.target.tolist(), network.weight.tolist()))
+
+    return [nodes_path, edges_path]
+
+
+
+@writer("parquet", [".nodes.parquet", ".edges.parquet"])
+def write_parquet(network, sql_file, config=None, **options):
+    """Writes a network as two Parquet files: a list of nodes (`topic.nodes.parquet`) and a list of links (`topic.edges.parquet`)."""
+    if not network.n_nodes:
+        return []
+    nodes_path = output_path(sql_file, network.task, ".nodes.parquet")
+    edges_path = output_path(sql_file, network.task, ".edges.parquet")
+
+    pq.write_table(pyarrow.table(_node_columns(network)), f"{nodes_path}.tmp")
+    os.replace(f"{nodes_path}.tmp", nodes_path)
+    edges = pyarrow.table({"source": network.source, "target": network.target, "weight": network.weight})
+    pq.write_table(edges, f"{edges_path}.tmp")
+    os.replace(f"{edges_path}.tmp", edges_path)
+
+    return [nodes_path, edges_path]
@@ -15,9 +15,14 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(HERE))  # one level above 'networ
 PROJECT_STATIC_PATH =  PROJECT_ROOT + "/src/html" 
 DEFAULT_TOPICS_SQL_PATH = PROJECT_ROOT + "/topics"
 DEFAULT_TOPICS_JSON_PATH = DEFAULT_TOPICS_SQL_PATH + "/json"
+DEFAULT_BUILD_MANIFEST = DEFAULT_TOPICS_JSON_PATH + "/build-manifest.json"
 
 DEFAULT_BUILD_PATH = PROJECT_ROOT + "/build"
 DEFAULT_BUILD_TOPICS_PATH = DEFAULT_BUILD_PATH + "/topics"
+DEFAULT_BUILD_RELEASES_PATH = PROJECT_ROOT + "/build-releases"  # `build` is a symlink to one of them
+
+DEFAULT_CACHE_PATH = PROJECT_ROOT + "/cache"
+DEFAULT_SNAPSHOT_PATH = PROJECT_ROOT + "/snapshot"
 
 DEFAULT_NETWORK_INIT = PROJECT_ROOT + "/src/networkgen/config_default.ini"
 
@@ -25,6 +30,15 @@ DEFAULT_NETWORK_INIT = PROJECT_ROOT + "/src/networkgen/config_default.ini"
 # network visualizations tasks available
 NETWORK_TYPES = ['concepts', 'organizations']
 
+# where networks are computed: in BigQuery, or locally from a snapshot of the publications table
+BACKENDS = ['bigquery', 'local']
+
+# node and link labels used in the visualizations, for each network type
+NETWORK_LABELS = {
+    'concepts' : ('Concept', 'Concept'),
+    'organizations' : ('Organization', 'Organization'),
+}
+
 # network visualizations parameters
 NETWORK_PARAMETERS_DEFAULT = {
     'network_types' : ", ".join(NETWORK_TYPES), 
@@ -32,7 +46,101 @@ NETWORK_PARAMETERS_DEFAULT = {
     'min_edge_weight' : 3 ,
     'min_concept_relevance': 0.5, 
     'min_concept_frequency': 5, 
+    'prune': 'none',
+    'prune_top_k': 10,
+    'prune_top_n': 5000,
+    'prune_alpha': 0.05,
+    'detail_levels': '',  # e.g. '1000, 5000'
+}
+
+# ways of reducing the number of links of a network, before writing it (`prune` parameter)
+PRUNE_METHODS = ['none', 'top_k', 'top_n', 'backbone']
+
+# layout of the networks computed at build time (VOS mapping, see layout.py)
+LAYOUT_ATTRACTION = 5  # same as the defaults of the viewer, in wrapper.html
+LAYOUT_REPULSION = 2
+LAYOUT_MAX_ITERATIONS = 1000
+LAYOUT_MIN_STEP = 0.001
+LAYOUT_STEP_REDUCTION = 0.75
+LAYOUT_SEED = 0
+# larger networks are laid out by the viewer: the layout takes quadratic time and memory in the number of
+# nodes (measured with tools/benchmark_clustering.py: about 7s for 500 nodes, 30s for 1000, over 2 minutes for 2000)
+LAYOUT_MAX_NODES = 500
+
+# networks with more links are written while reading the query results, at constant memory, without
+# build-time layout nor clusters (left to the viewer), unless they are pruned or have levels of detail
+STREAM_MIN_LINKS = 100000
+
+# clustering of the networks computed at build time (Louvain, see clustering.py)
+CLUSTERING_RESOLUTION = 1.0
+CLUSTERING_MAX_PASSES = 100  # max passes of local moving, per level
+
+# topic subsets materialized in BigQuery (--materialize-subset) are reused for this long, in seconds:
+# BigQuery deletes these temporary tables after about 24 hours
+SUBSET_TABLE_TTL = 60 * 60 * 12
+
+# max number of topics combined in a single query, in batch mode
+BATCH_MAX_TOPICS = 50
+
+# max number of HTTP connections kept open to BigQuery (shared by all queries)
+BQ_HTTP_POOL_SIZE = 10
+
+# query results cache
+# use: read and write cached results / refresh: re-run queries and overwrite results / off: no cache
+CACHE_MODES = ['use', 'refresh', 'off']
+QUERY_CACHE_TTL = 60 * 60 * 24 * 7  # seconds
+QUERY_CACHE_MAX_SIZE = 500 * 1024 * 1024  # bytes
+
+# website files served precompressed (paths relative to the build folder)
+PRECOMPRESS_PATTERNS = ['topics/json/*/*.json', 'topics/*.json', '*.bundle.js', '*.worker.js']
+PRECOMPRESS_MIN_SIZE = 1024  # bytes
+PRECOMPRESS_GZIP_LEVEL = 9
+PRECOMPRESS_BROTLI_QUALITY = 11
+PRECOMPRESS_MANIFEST = '.precompressed.json'  # hashes of the compressed files, in the build folder
+
+# index pages of the website (see catalogue.py)
+INDEX_PAGE_SIZE = 24  # topics per page
+INDEX_PAGINATION_WINDOW = 3  # links to the pages before and after the current one
+SITE_TOPICS_MANIFEST = 'topics/manifest.json'  # metadata of all topics
+SITE_SEARCH_INDEX = 'topics/search-index.json'  # words of the topic names and queries => topics
+SEARCH_INDEX_MIN_LENGTH = 3  # shorter words are not indexed
+SEARCH_INDEX_STOPWORDS = {  # SQL keywords, found in all queries
+    'select', 'from', 'where', 'and', 'not', 'null', 'join', 'left', 'inner', 'outer', 'unnest', 'cross',
+    'group', 'order', 'having', 'limit', 'distinct', 'with', 'case', 'when', 'then', 'else', 'end',
+    'like', 'between', 'exists', 'true', 'false', 'count', 'array', 'struct', 'cast', 'date', 'timestamp',
+    'string', 'int64', 'lower', 'upper', 'extract', 'interval', 'current_date',
 }
 
+# website releases (see publish.py)
+SITE_MANIFEST = '.site-manifest.json'  # hashes of the files of a release, in its folder
+SITE_KEEP_RELEASES = 2  # the current release and the previous one, which may still be read by the server
+
+# local web server (--runserver)
+SERVER_GZIP_MIN_SIZE = 1024  # bytes, smaller files are not compressed on the fly
+SERVER_GZIP_LEVEL = 6
+SERVER_GZIP_TYPES = ['text/', 'application/json', 'application/javascript', 'image/svg+xml']
+SERVER_GZIP_CACHE_SIZE = 64 * 1024 * 1024  # bytes of compressed responses kept in memory
+# files whose name contains a content hash (eg `c425e4124779d436de40.worker.js`) never change
+SERVER_IMMUTABLE_PATTERN = r'(^|[.\-])[0-9a-f]{16,}[.\-]'
+SERVER_IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365  # seconds
+
+# networks generated on demand by the web server (--runserver --api)
+API_PARAMETERS = ['max_nodes', 'min_edge_weight', 'min_concept_relevance', 'min_concept_frequency']  # can be set in requests
+API_MAX_NODES = 5000  # largest `max_nodes` accepted in requests
+API_MAX_JOBS = 2  # networks generated at the same time, further requests wait for their turn
+API_QUEUE_TIMEOUT = 60  # seconds a request waits for its turn, before failing with 503
+DEFAULT_API_CACHE_PATH = DEFAULT_CACHE_PATH + "/api"
+API_CACHE_TTL = 60 * 60 * 24  # seconds
+API_CACHE_MAX_SIZE = 200 * 1024 * 1024  # bytes, on disk
+API_MEMORY_CACHE_SIZE = 64 * 1024 * 1024  # bytes, in memory
+
+# neighbourhoods of nodes of the built networks, served by the web server (/api/ego)
+API_EGO_TOP = 20  # default number of neighbours kept per node
+API_EGO_MAX_TOP = 200
+
+# --watch mode: topic files changes are handled once no file has changed for WATCH_DEBOUNCE seconds
+WATCH_DEBOUNCE = 0.5  # seconds
+WATCH_POLL_INTERVAL = 1  # seconds, when watchdog is not installed (otherwise only as a safety net)
+
 
 BASE_DIMENSIONS_URL = """https://app.dimensions.ai/discover/publication?search_text=%222019-nCoV%22%20OR%20%22COVID-19%22%20OR%20%E2%80%9CSARS-CoV-2%E2%80%9D%20OR%20%22HCoV-2019%22%20OR%20%22hcov%22%20OR%20%22NCOVID-19%22%20OR%20%22severe%20acute%20respiratory%20syndrome%20coronavirus%202%22%20OR%20%22severe%20acute%20respiratory%20syndrome%20corona%20virus%202%22%20OR%20%E2%80%9Ccoronavirus%20disease%202019%E2%80%9D%20OR%20((%22coronavirus%22%20OR%20%22corona%20virus%22)%20AND%20(Wuhan%20OR%20China%20OR%20novel)){custom_search}&search_type=kws&search_field=full_search&search_mode=content&or_facet_year=2022&or_facet_year=2021&or_facet_year=2020"""
\ No newline at end of file
@@ -0,0 +1,82 @@
+"""
+Benchmark of the build-time clustering (and layout) of networks.
+
+Times the clustering and layout of existing network files, e.g. the sample ones in /docs,
+and of synthetic networks of the size of the largest full Dimensions networks:
+
+    $ python tools/benchmark_clustering.py docs/topics/json/concepts/*.json
+    $ python tools/benchmark_clustering.py --synthetic 5000 1000000
+
+The time taken by the viewer to do the same is not measured by this script, as it runs in
+the browser: to compare, open the same network with the developer tools' performance
+profiler running, and look for the time spent in the VOSviewer web worker (`*.worker.js`)
+before the network is displayed.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the project folder, for `src`
+
+from src.networkgen.clustering import adjacency_matrix, louvain, modularity
+from src.networkgen.layout import vos_layout
+from src.networkgen.network import Network
+from src.settings import LAYOUT_MAX_NODES
+
+
+
+def load_network(path):
+    """Reads the links of a VOSviewer JSON file, as a Network."""
+    with open(path, "r") as input:
+        network = json.load(input)["network"]
+    return Network.from_rows(None, ((l["source_id"], l["target_id"], l["strength"]) for l in network["links"]))
+
+
+
+def synthetic_network(n_nodes, n_links, n_groups=50, seed=0):
+    """Returns a random network with `n_groups` communities, as a Network."""
+    rng = np.random.default_rng(seed)
+    group = rng.integers(0, n_groups, n_links)
+    size = n_nodes // n_groups
+    source = group * size + rng.integers(0, size, n_links)
+    target = np.where(rng.random(n_links) < 0.2, rng.integers(0, n_nodes, n_links), group * size + rng.integers(0, size, n_links))
+    keep = source < target
+    weight = rng.integers(1, 20, keep.sum())
+    return Network(None, [str(x) for x in range(n_nodes)], source[keep], target[keep], weight)
+
+
+
+def benchmark(name, network):
+    start = time.perf_counter()
+    A = adjacency_matrix(network.n_nodes, network.source, network.target, network.weight)
+    clusters = louvain(A)
+    clustering_time = time.perf_counter() - start
+
+    if network.n_nodes <= LAYOUT_MAX_NODES:
+        start = time.perf_counter()
+        vos_layout(network.n_nodes, network.source, network.target, network.weight)
+        layout_time = f"{time.perf_counter() - start:8.2f}s"
+    else:
+        layout_time = f"{'n/a':>9}"
+
+    print(f"{network.n_nodes:>7} {network.n_links:>9} {clusters.max():>9} {modularity(A, clusters - 1):>11.3f} {clustering_time:>10.2f}s {layout_time}  {name}")
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark of the build-time clustering and layout of networks.")
+    parser.add_argument("files", nargs="*", help="VOSviewer JSON network files")
+    parser.add_argument("--synthetic", nargs=2, type=int, action="append", metavar=("NODES", "LINKS"), default=[],
+                        help="Also benchmark a random network of this size (can be repeated)")
+    args = parser.parse_args()
+
+    print(f"{'Nodes':>7} {'Links':>9} {'Clusters':>9} {'Modularity':>11} {'Clustering':>11} {'Layout':>9}  Network")
+    for path in args.files:
+        benchmark(path, load_network(path))
+    for n_nodes, n_links in args.synthetic:
+        benchmark(f"synthetic ({n_nodes} nodes, {n_links} random links)", synthetic_network(n_nodes, n_links))
@@ -0,0 +1,140 @@
+"""
+Load test of the local web server (`dimensions-networks --runserver`).
+
+Serves a website folder (by default the sample one in /docs) with both the previous
+single-threaded server (socketserver.TCPServer + SimpleHTTPRequestHandler) and the
+current one (see src/networkgen/server.py), and reports the throughput and latency of
+concurrent clients downloading its network files:
+
+    $ python tools/load_test_server.py
+    $ python tools/load_test_server.py build --clients 16 --requests 50 --slow-clients 2
+
+Slow clients download the largest file over and over, sending their requests slowly as
+over a bad connection, while the other clients are timed. With `--revalidate`, clients send the ETag of their
+first response back (If-None-Match), as a browser with a cached copy does.
+"""
+
+import argparse
+import functools
+import glob
+import http.client
+import http.server
+import os
+import socket
+import socketserver
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # the project folder, for `src`
+
+from src.networkgen.server import CachingHandler, make_server
+
+
+
+class QuietBaselineHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class QuietHandler(CachingHandler):
+    def log_message(self, *args):
+        pass
+
+
+def baseline_server(directory):
+    handler = functools.partial(QuietBaselineHandler, directory=directory)
+    return socketserver.TCPServer(("127.0.0.1", 0), handler)
+
+
+def current_server(directory):
+    return make_server(0, directory, host="127.0.0.1", handler=QuietHandler)
+
+
+
+def client(port, paths, n_requests, revalidate):
+    """Fetches `n_requests` files, over a persistent connection when the server allows it. Returns the latencies."""
+    latencies, etags = [], {}
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    for n in range(n_requests):
+        path = paths[n % len(paths)]
+        headers = {"Accept-Encoding": "gzip, br"}
+        if revalidate and path in etags:
+            headers["If-None-Match"] = etags[path]
+        start = time.perf_counter()
+        connection.request("GET", path, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - start)
+        if response.getheader("ETag"):
+            etags[path] = response.getheader("ETag")
+        if response.will_close:
+            connection.close()
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    connection.close()
+    return latencies
+
+
+def slow_client(port, path, stop, delay=0.05):
+    """
+    Downloads a file over and over, as over a slow connection: the request headers are sent
+    one at a time, every `delay` seconds, and the response is read in small chunks.
+    """
+    while not stop.is_set():
+        with socket.create_connection(("127.0.0.1", port), timeout=120) as sock:
+            sock.sendall(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\n".encode())
+            for n in range(20):
+                if stop.is_set():
+                    return
+                time.sleep(delay)
+                sock.sendall(f"X-Header-{n}: value\r\n".encode())
+            sock.sendall(b"Connection: close\r\n\r\n")
+            while not stop.is_set() and sock.recv(16 * 1024):
+                time.sleep(delay / 10)
+
+
+
+def load_test(name, server, paths, args):
+    port = server.server_address[1]
+    server.handle_error = lambda *args: None  # slow clients hang up when the test ends
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stop = threading.Event()
+    largest = max(paths, key=lambda p: os.path.getsize(os.path.join(args.directory, p.lstrip("/"))))
+    slow = [threading.Thread(target=slow_client, args=(port, largest, stop), daemon=True) for _ in range(args.slow_clients)]
+    for thread in slow:
+        thread.start()
+    time.sleep(0.2 if slow else 0)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as pool:
+        results = list(pool.map(lambda _: client(port, paths, args.requests, args.revalidate), range(args.clients)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    server.shutdown()
+    server.server_close()
+
+    latencies = sorted(x for result in results for x in result)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{name:<10} {len(latencies) / elapsed:>10.1f} {statistics.median(latencies) * 1000:>10.1f} {p95 * 1000:>10.1f} {elapsed:>9.2f}s")
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test of the local web server.")
+    parser.add_argument("directory", nargs="?", default="docs", help="Website folder to serve (default: docs)")
+    parser.add_argument("--clients", type=int, default=8, help="Number of concurrent clients (default: 8)")
+    parser.add_argument("--requests", type=int, default=20, help="Number of requests per client (default: 20)")
+    parser.add_argument("--slow-clients", type=int, default=1, help="Number of slow clients downloading the largest file meanwhile (default: 1)")
+    parser.add_argument("--revalidate", action="store_true", help="Send conditional requests for files already downloaded")
+    args = parser.parse_args()
+
+    paths = sorted("/" + os.path.relpath(f, args.directory) for f in glob.glob(f"{args.directory}/topics/json/*/*.json"))
+    if not paths:
+        parser.error(f"No network files found in {args.directory}/topics/json")
+
+    print(f"{len(paths)} files, {args.clients} clients x {args.requests} requests, {args.slow_clients} slow clients")
+    print(f"{'Server':<10} {'Requests/s':>10} {'Median ms':>10} {'p95 ms':>10} {'Time':>10}")
+    load_test("baseline", baseline_server(args.directory), paths, args)
+    load_test("threaded", current_server(args.directory), paths, args)